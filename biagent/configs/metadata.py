@@ -10,6 +10,7 @@ META_FIELD_DEFINITIONS = [
         "name": "library preparation platform",
         "type": "str",
         "description": "RNA-seq library preparation platform, for exsample 10x Chromium (v2), 10x Chromium (v3), Smart-seq2, etc",
+        "required": True,
     },
     {
         "name": "library kit",
@@ -35,6 +36,7 @@ META_FIELD_DEFINITIONS = [
         "name": "expression calculation in the supplementary files",
         "type": "str",
         "description": "read count/CPM/FPKM/TMP, whether log transformed, use supplementary file names for more information",
+        "infer_from_matrix": True,
     },
     {
         "name": "reference genome",
@@ -50,6 +52,7 @@ META_FIELD_DEFINITIONS = [
         "name": "bulk or single-cell or single-nucleus",
         "type": "str",
         "description": "bulk or single-cell or single-nucleus sample",
+        "required": True,
     },
     {
         "name": "condition",
@@ -62,6 +65,7 @@ META_FIELD_DEFINITIONS = [
         "type": "str",
         "description": "origin of organ/tissue",
         "map_to_umls": True,
+        "required": True,
     },
     {
         "name": "cell line",
@@ -154,3 +158,26 @@ META_FIELD_DEFINITIONS = [
 ]
 
 DEFAULT_META_FIELD_GROUP = MetaFieldList.model_validate(META_FIELD_DEFINITIONS)
+
+# the token budget of the sample metadata in each prompt
+METADATA_TOKEN_BUDGET = 3000
+# the SOFT fields kept first when the metadata exceeds the budget, matched by prefix,
+# the fields not listed come last
+METADATA_FIELD_PRIORITY = [
+    "Sample_title",
+    "Sample_source_name",
+    "Sample_organism",
+    "Sample_characteristics",
+    "Sample_molecule",
+    "Sample_library_strategy",
+    "Sample_library_source",
+    "Sample_library_selection",
+    "Sample_instrument_model",
+    "Series_title",
+    "Series_overall_design",
+    "Sample_extract_protocol",
+    "Sample_data_processing",
+    "Sample_description",
+    "Sample_supplementary_file",
+    "Series_supplementary_file",
+]
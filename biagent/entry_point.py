@@ -1,18 +1,66 @@
 import argparse
 import json
+import os
 
 import pandas as pd
+import scanpy as sc
 
 from biagent.tools import GeoCountMatrixReader, PipelineExtractor
+from biagent.tools.count_matrix_reader import DEFAULT_CACHE_DIR
 from biagent.utils import geo_helpers
-from biagent.utils.metadata_helpers import metadata_task, metadata_task_soft_file_list
+from biagent.utils.count_matrix_helpers import CountMatrixSelection
+from biagent.utils.llm_helpers import (
+    configure_hedging,
+    configure_rate_limiter,
+    get_llm_config,
+)
+from biagent.utils.metadata_helpers import (
+    emit_metadata_batch,
+    ingest_metadata_batch,
+    load_soft_file_list,
+    metadata_task,
+    metadata_task_soft_file_list,
+)
+from biagent.utils.pipeline_extractor_helpers import pipeline_task_paper_list
+
+
+def _parse_list_arg(value: str | None) -> list[str] | None:
+    """Parse a comma separated list, or read it from a file with one item per line."""
+    if value is None:
+        return None
+    if os.path.isfile(value):
+        with open(value, "r") as f:
+            return [l.strip() for l in f if l.strip()]
+    return [v.strip() for v in value.split(",") if v.strip()]
 
 
 def cli():
     parser = argparse.ArgumentParser(
         description="A CLI tool to run biagent",
     )
-    parser.add_argument("--model", type=str, default="qwen1.5-72b-chat")
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="qwen1.5-72b-chat",
+        help="The model, or a comma separated cascade from the cheapest to the most capable",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=None,
+        help="The requests per minute quota of the model server",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        default=None,
+        help="The tokens per minute quota of the model server",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Duplicate the LLM requests slower than the 95th latency percentile",
+    )
     subparsers = parser.add_subparsers(dest="subparser_name")
 
     metadata_subparser = subparsers.add_parser(
@@ -21,6 +69,13 @@ def cli():
     metadata_subparser.add_argument(
         "--gsm_id", type=str, help="GSM ID", required=False, default=None
     )
+    metadata_subparser.add_argument(
+        "--count_matrix",
+        type=str,
+        required=False,
+        default=None,
+        help="The h5ad file of the sample's count matrix, used to infer the expression calculation",
+    )
     metadata_subparser.add_argument(
         "--soft_file_list",
         type=str,
@@ -55,20 +110,78 @@ def cli():
         default=None,
         help="The cache directory",
     )
+    metadata_batch_group = metadata_subparser.add_mutually_exclusive_group()
+    metadata_batch_group.add_argument(
+        "--emit_batch",
+        "--emit-batch",
+        type=str,
+        required=False,
+        default=None,
+        help="Write the prompts to this batch request file instead of calling the LLM",
+    )
+    metadata_batch_group.add_argument(
+        "--ingest_batch",
+        "--ingest-batch",
+        type=str,
+        required=False,
+        default=None,
+        help="Read the LLM replies from this batch response file",
+    )
     count_matrix_subparser = subparsers.add_parser(
         "count_matrix", help="Read the count matrix from a chosen GEO sample"
     )
-    count_matrix_subparser.add_argument(
+    count_matrix_group = count_matrix_subparser.add_mutually_exclusive_group(
+        required=True
+    )
+    count_matrix_group.add_argument(
         "--gsm_id",
         type=str,
         help="a valid GEO sample ID",
-        required=True,
+    )
+    count_matrix_group.add_argument(
+        "--gse_id",
+        type=str,
+        help="a valid GEO series ID, all samples are read from the series-level files",
     )
     count_matrix_subparser.add_argument(
         "--output",
         type=str,
         required=True,
-        help="The output h5ad file path",
+        help="The output h5ad file path, or the output directory if `--gse_id` is given",
+    )
+    count_matrix_subparser.add_argument(
+        "--genes",
+        type=str,
+        required=False,
+        default=None,
+        help="Only load these genes, comma separated or a file with one gene per line",
+    )
+    count_matrix_subparser.add_argument(
+        "--cells",
+        type=str,
+        required=False,
+        default=None,
+        help="Only load these cell barcodes, comma separated or a file with one per line",
+    )
+    count_matrix_subparser.add_argument(
+        "--obs_filter",
+        "--obs-filter",
+        type=str,
+        required=False,
+        default=None,
+        help="Only load the cells matching this pandas query over `adata.obs`",
+    )
+    count_matrix_subparser.add_argument(
+        "--cache_dir",
+        type=str,
+        required=False,
+        default=DEFAULT_CACHE_DIR,
+        help="The directory of cached count matrices",
+    )
+    count_matrix_subparser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Do not read or write cached count matrices",
     )
     geo_search_subparser = subparsers.add_parser(
         "geo_search", help="Search GEO for samples"
@@ -91,12 +204,151 @@ def cli():
         help="path to the output pipeline file, html or json",
         required=True,
     )
+    pipeline_extractor_subparser.add_argument(
+        "--retrieval_top_k",
+        type=int,
+        required=False,
+        default=None,
+        help="Only send the top-k paragraphs ranked by BM25 to the LLM for each task",
+    )
+    pipeline_extractor_subparser.add_argument(
+        "--parallel",
+        type=int,
+        required=False,
+        default=1,
+        help="The number of pipeline tasks of the same layer extracted concurrently",
+    )
+    pipeline_extractor_subparser.add_argument(
+        "--window_tokens",
+        type=int,
+        required=False,
+        default=None,
+        help="Pack consecutive paragraphs up to this many tokens into each prompt",
+    )
+    pipeline_extractor_subparser.add_argument(
+        "--all_sections",
+        action="store_true",
+        help="Send the whole paper instead of only its methods sections",
+    )
+    pipeline_extractor_subparser.add_argument(
+        "--strategy",
+        type=str,
+        required=False,
+        default="per_node",
+        choices=["per_node", "single_pass"],
+        help="Scan the paper once per task, or once for all tasks",
+    )
+    pipeline_extractor_subparser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the LLM responses and stop them once a valid JSON has arrived",
+    )
+
+    pipeline_batch_subparser = subparsers.add_parser(
+        "pipeline_batch", help="Extract the pipelines from many papers"
+    )
+    pipeline_batch_subparser.add_argument(
+        "--papers",
+        type=str,
+        help="a directory of papers in `md` format, or a file listing one paper per line",
+        required=True,
+    )
+    pipeline_batch_subparser.add_argument(
+        "--output_dir",
+        type=str,
+        help="the directory of the per-paper results and the consolidated jsonl",
+        required=True,
+    )
+    pipeline_batch_subparser.add_argument(
+        "--parallel",
+        type=int,
+        required=False,
+        default=1,
+        help="The number of papers processed in parallel",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--cache_dir",
+        type=str,
+        required=False,
+        default=".cache",
+        help="The directory of the shared LLM response cache",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--retrieval_top_k",
+        type=int,
+        required=False,
+        default=None,
+        help="Only send the top-k paragraphs ranked by BM25 to the LLM for each task",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--window_tokens",
+        type=int,
+        required=False,
+        default=None,
+        help="Pack consecutive paragraphs up to this many tokens into each prompt",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--all_sections",
+        action="store_true",
+        help="Send the whole paper instead of only its methods sections",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--strategy",
+        type=str,
+        required=False,
+        default="per_node",
+        choices=["per_node", "single_pass"],
+        help="Scan the paper once per task, or once for all tasks",
+    )
+    pipeline_batch_subparser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the LLM responses and stop them once a valid JSON has arrived",
+    )
 
     args = parser.parse_args()
+    # the model is only resolved for the quotas, so a search accepts any model name
+    throttled = args.subparser_name != "geo_search" and (
+        args.rpm is not None or args.tpm is not None or args.hedge
+    )
+    model_servers = (
+        {get_llm_config(m.strip())["model_server"] for m in args.model.split(",")}
+        if throttled
+        else set()
+    )
+    for model_server in model_servers:
+        if args.rpm is not None or args.tpm is not None:
+            configure_rate_limiter(model_server, rpm=args.rpm, tpm=args.tpm)
+        if args.hedge:
+            configure_hedging(model_server)
 
-    if args.subparser_name == "metadata":
+    if args.subparser_name == "metadata" and (args.emit_batch or args.ingest_batch):
+        if args.gsm_id:
+            gsms = [geo_helpers.get_geo(args.gsm_id, return_gse=True)]
+        elif args.soft_file_list:
+            gsms = load_soft_file_list(
+                args.soft_file_list, args.max_gsms_per_gse, args.parallel
+            )
+        else:
+            raise ValueError("Please provide either gsm_id or soft_file_list")
+        if args.emit_batch:
+            emit_metadata_batch(gsms, args.model, args.emit_batch)
+        else:
+            metadatas = ingest_metadata_batch(gsms, args.ingest_batch)
+            if args.output:
+                pd.DataFrame(metadatas).to_csv(
+                    args.output, index=False, encoding="utf-8"
+                )
+            else:
+                print(metadatas)
+    elif args.subparser_name == "metadata":
         if args.gsm_id:
-            metadatas = [metadata_task(args.gsm_id, args.model)]
+            adata = (
+                sc.read_h5ad(args.count_matrix, backed="r")
+                if args.count_matrix
+                else None
+            )
+            metadatas = [metadata_task(args.gsm_id, args.model, adata=adata)]
         elif args.soft_file_list:
             assert args.output is not None, "Please provide output file path"
             metadatas = metadata_task_soft_file_list(
@@ -117,12 +369,46 @@ def cli():
         results = geo_helpers.search_geo_records(args.query)
         print(json.dumps(results, indent=2))
     elif args.subparser_name == "count_matrix":
-        count_matrix_reader = GeoCountMatrixReader(llm=args.model)
-        adata = count_matrix_reader.process_gsm(args.gsm_id)
-        adata.write_h5ad(args.output)
+        count_matrix_reader = GeoCountMatrixReader(
+            llm=args.model, cache_dir=None if args.no_cache else args.cache_dir
+        )
+        selection = CountMatrixSelection(
+            genes=_parse_list_arg(args.genes),
+            cells=_parse_list_arg(args.cells),
+            obs_filter=args.obs_filter,
+        )
+        if args.gse_id:
+            os.makedirs(args.output, exist_ok=True)
+            for gsm_id, adata in count_matrix_reader.process_gse(args.gse_id).items():
+                adata = selection.apply(adata)
+                adata.write_h5ad(os.path.join(args.output, f"{gsm_id}.h5ad"))
+        else:
+            adata = count_matrix_reader.process_gsm(args.gsm_id, selection=selection)
+            adata.write_h5ad(args.output)
     elif args.subparser_name == "pipeline_extractor":
-        pipeline_extractor = PipelineExtractor(llm=args.model)
+        pipeline_extractor = PipelineExtractor(
+            llm=args.model,
+            retrieval_top_k=args.retrieval_top_k,
+            max_workers=args.parallel,
+            window_tokens=args.window_tokens,
+            methods_only=not args.all_sections,
+            strategy=args.strategy,
+            stream=args.stream,
+        )
 
         pipeline_extractor.extract_pipeline(args.parsed_paper, args.output)
+    elif args.subparser_name == "pipeline_batch":
+        pipeline_task_paper_list(
+            args.papers,
+            args.model,
+            args.parallel,
+            args.output_dir,
+            cache_dir=args.cache_dir,
+            retrieval_top_k=args.retrieval_top_k,
+            window_tokens=args.window_tokens,
+            methods_only=not args.all_sections,
+            strategy=args.strategy,
+            stream=args.stream,
+        )
     else:
         raise NotImplementedError
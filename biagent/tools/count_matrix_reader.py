@@ -1,3 +1,11 @@
+import functools
+import hashlib
+import inspect
+import os
+import threading
+
+import scipy.sparse
+from GEOparse.GEOTypes import GSM
 from jinja2 import Template
 from modelscope_agent.llm import get_chat_model
 from modelscope_agent.llm.base import BaseChatModel
@@ -6,11 +14,53 @@ from scanpy import AnnData
 
 from biagent import prompts
 from biagent.types import FileType
-from biagent.utils import geo_helpers
+from biagent.utils import count_matrix_helpers, geo_helpers
 from biagent.utils.code_runner import safe_exec_func
+from biagent.utils.count_matrix_helpers import (
+    AnnDataCache,
+    CountMatrixSelection,
+    read_10x_h5,
+    read_h5ad,
+    series_sample_mask,
+)
 from biagent.utils.llm_helpers import get_chat_model
+from biagent.utils.logger import biagent_logger as logger
 from biagent.utils.output_parser import parse_python_markdown
 
+DEFAULT_CACHE_DIR = os.path.join(geo_helpers.GEO_PATH, "biagent_count_matrix")
+
+
+@functools.lru_cache(maxsize=None)
+def reader_version() -> str:
+    """
+    Hash of the code and prompts that produce a count matrix, part of the cache key.
+    Only the readers are hashed, so unrelated edits keep the cached matrices.
+    """
+    reader_code = [
+        GeoCountMatrixReader._read_anndata,
+        GeoCountMatrixReader._slice_series,
+        GeoCountMatrixReader.process_series,
+        geo_helpers.check_file_type,
+        geo_helpers.peek_supp_data,
+        count_matrix_helpers.series_sample_mask,
+        count_matrix_helpers.CountMatrixSelection,
+        count_matrix_helpers._decompressed,
+        count_matrix_helpers._index_lookup,
+        count_matrix_helpers.read_mtx,
+        count_matrix_helpers._contiguous_runs,
+        count_matrix_helpers.read_10x_h5,
+        count_matrix_helpers.read_h5ad,
+        count_matrix_helpers._read_header,
+        count_matrix_helpers.read_table_sparse,
+    ]
+    digest = hashlib.sha256()
+    for obj in reader_code:
+        digest.update(inspect.getsource(obj).encode())
+    for template in GeoCountMatrixReader.prompt_templates.values():
+        with open(template.filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
 
 @register_tool("geo_count_matrix_reader")
 class GeoCountMatrixReader(BaseTool):
@@ -34,9 +84,16 @@ class GeoCountMatrixReader(BaseTool):
         self,
         llm: str | dict | BaseChatModel,
         cfg: dict | None = {},
+        cache_dir: str | None = DEFAULT_CACHE_DIR,
     ):
         super().__init__(cfg)
         self.llm = get_chat_model(llm)
+        # results are cached on disk unless `cache_dir` is None
+        self.cache = AnnDataCache(cache_dir) if cache_dir is not None else None
+        # series-level matrices parsed so far, shared by all samples of a series
+        self._series_cache: dict[str, AnnData] = {}
+        self._series_locks: dict[str, threading.Lock] = {}
+        self._series_lock = threading.Lock()
 
     def _construct_context(self, file_content: dict) -> str:
         final_str = "### SUPP FILES\n"
@@ -45,16 +102,35 @@ class GeoCountMatrixReader(BaseTool):
             final_str += f'\n```\n{file_content["content"][j]}\n```'
         return final_str
 
-    def process_gsm(self, gsm_id: str) -> AnnData:
-        # step 1: determine whether using supp files or process fastq files
-        file_content = geo_helpers.get_supp_data(gsm_id)
-        if len(file_content["files"]) == 0:
-            raise ValueError("No supplementary file found")
-        # step 2: Anndata reading
+    def _find_file(self, file_content: dict, suffix: str) -> str:
+        for f in file_content["files"]:
+            if f.lower().removesuffix(".gz").endswith(suffix):
+                return os.path.join(file_content["dir"], f)
+        raise ValueError(f"No `{suffix}` file found")
+
+    def _read_anndata(
+        self, file_content: dict, selection: CountMatrixSelection | None = None
+    ) -> AnnData:
+        if selection is None:
+            selection = CountMatrixSelection()
         file_type = geo_helpers.check_file_type(file_content)
 
         if file_type == FileType.UNKNOWN:
             raise ValueError("Unknown file type")
+        # HDF5 based formats are read directly, only the selection is loaded
+        if file_type == FileType.H5AD:
+            return read_h5ad(self._find_file(file_content, ".h5ad"), selection)
+        if file_type == FileType.H5:
+            adata = read_10x_h5(
+                self._find_file(file_content, ".h5"),
+                genes=selection.genes,
+                cells=selection.cells,
+            )
+            return CountMatrixSelection(obs_filter=selection.obs_filter).apply(adata)
+        if file_type not in self.prompt_templates:
+            raise ValueError(f"Unsupported file type: {file_type.name}")
+
+        file_content = geo_helpers.peek_supp_data(file_content)
         context = self._construct_context(file_content)
 
         template = self.prompt_templates[file_type]
@@ -65,14 +141,137 @@ class GeoCountMatrixReader(BaseTool):
             raise ValueError(f"Error reading count matrix: {reply}")
 
         code = parse_python_markdown(reply)
-        final_result = safe_exec_func(code, param_space={})
+        final_result = safe_exec_func(
+            code, param_space={"GENES": selection.genes, "CELLS": selection.cells}
+        )
         if "adata" not in final_result or not isinstance(
             final_result["adata"], AnnData
         ):
             raise ValueError(f"Error reading count matrix: {reply}")
         adata = final_result["adata"]
+        return selection.apply(adata)
+
+    def _cache_key(self, accession: str, file_content: dict) -> str:
+        names = set(file_content["files"])
+        # decompressed copies left next to their source by older versions
+        files = [
+            os.path.join(file_content["dir"], f)
+            for f in file_content["files"]
+            if f + ".gz" not in names
+        ]
+        return self.cache.key(accession, files, reader_version())
+
+    def process_series(self, gse_id: str) -> AnnData:
+        """
+        Read the series-level count matrix of a GSE, covering all of its samples.
+        The files are downloaded and parsed once, the result is kept as a CSR matrix
+        in memory and in the result cache.
+        """
+        with self._series_lock:
+            lock = self._series_locks.setdefault(gse_id, threading.Lock())
+        with lock:
+            if gse_id in self._series_cache:
+                return self._series_cache[gse_id]
+
+            file_content = geo_helpers.get_series_supp_data(gse_id, peek=False)
+            if len(file_content["files"]) == 0:
+                raise ValueError(f"No series-level supplementary file for {gse_id}")
+            adata = None
+            if self.cache is not None:
+                key = self._cache_key(gse_id, file_content)
+                adata = self.cache.get(gse_id, key)
+            if adata is None:
+                adata = self._read_anndata(file_content)
+                adata.X = scipy.sparse.csr_matrix(adata.X)
+                if self.cache is not None:
+                    self.cache.put(gse_id, key, adata)
+            self._series_cache[gse_id] = adata
+            return adata
+
+    def _slice_series(self, adata: AnnData, gsm: GSM) -> AnnData:
+        accession = gsm.get_accession()
+        title = gsm.metadata.get("title", [None])[0]
+        mask = series_sample_mask(adata.obs_names, accession, title)
+        if not mask.any():
+            raise ValueError(f"{accession} not found in the series-level count matrix")
+        return adata[mask].copy()
+
+    def process_gsm(
+        self,
+        gsm_id: str,
+        backed: bool = False,
+        selection: CountMatrixSelection | None = None,
+    ) -> AnnData:
+        """
+        Read the count matrix of a GEO sample.
+
+        Args:
+            gsm_id: a valid GEO sample ID
+            backed: open the cached result in backed mode instead of loading it,
+                only applies when the result cache is enabled
+            selection: the genes and cells to load, everything if None. The selection
+                is pushed down into the readers when possible
+        Returns:
+            AnnData: the count matrix with cells as observations
+        """
+        if selection is None:
+            selection = CountMatrixSelection()
+        # step 1: determine whether using supp files or process fastq files
+        file_content = geo_helpers.get_supp_data(gsm_id, peek=False)
+        gse_id = None
+        if len(file_content["files"]) == 0:
+            # fall back to the series-level files shared by all samples
+            gsm = geo_helpers.get_geo(gsm_id)
+            gse_ids = gsm.metadata.get("series_id", [])
+            if len(gse_ids) == 0:
+                raise ValueError("No supplementary file found")
+            gse_id = gse_ids[0]
+            logger.info(
+                f"No supplementary file found for {gsm_id}, using series {gse_id}"
+            )
+            file_content = geo_helpers.get_series_supp_data(gse_id, peek=False)
+            if len(file_content["files"]) == 0:
+                raise ValueError("No supplementary file found")
+
+        if self.cache is not None:
+            key = self._cache_key(gsm_id, file_content)
+            # a selection is sliced from the cached full matrix in backed mode
+            adata = self.cache.get(
+                gsm_id, key, backed=backed or not selection.is_empty()
+            )
+            if adata is not None:
+                return adata if selection.is_empty() else selection.apply(adata)
+
+        # step 2: Anndata reading
+        if gse_id is not None:
+            adata = selection.apply(
+                self._slice_series(self.process_series(gse_id), gsm)
+            )
+        else:
+            adata = self._read_anndata(file_content, selection)
+
+        # only full matrices are cached
+        if self.cache is not None and selection.is_empty():
+            self.cache.put(gsm_id, key, adata)
+            if backed:
+                return self.cache.get(gsm_id, key, backed=True)
         return adata
 
+    def process_gse(self, gse_id: str) -> dict[str, AnnData]:
+        """
+        Read the count matrices of all samples in a GSE from its series-level files,
+        returns a dictionary from GSM ID to AnnData.
+        """
+        adata = self.process_series(gse_id)
+        gse = geo_helpers.get_geo(gse_id)
+        results = {}
+        for gsm_id, gsm in gse.gsms.items():
+            try:
+                results[gsm_id] = self._slice_series(adata, gsm)
+            except ValueError as e:
+                logger.error(str(e))
+        return results
+
     def call(self, params: str, **kwargs) -> str:
         params = self._verify_args(params)
         gsm_id = params.get("id")
@@ -1,16 +1,24 @@
 import json
 
-from GEOparse.GEOTypes import GSE, GSM, NoMetadataException
+from GEOparse.GEOTypes import GSE, GSM
 from modelscope_agent.llm import get_chat_model
 from modelscope_agent.llm.base import BaseChatModel
 from modelscope_agent.tools.base import BaseTool, register_tool
-from modelscope_agent.utils.tokenization_utils import count_tokens
+from scanpy import AnnData
 
 from biagent import prompts
-from biagent.configs.metadata import DEFAULT_META_FIELD_GROUP
+from biagent.configs.metadata import (
+    DEFAULT_META_FIELD_GROUP,
+    METADATA_TOKEN_BUDGET,
+)
 from biagent.types import MetaFieldList
 from biagent.utils import geo_helpers
-from biagent.utils.llm_helpers import get_chat_model
+from biagent.utils.count_matrix_helpers import UNKNOWN, infer_expression_type
+from biagent.utils.llm_helpers import (
+    ModelCascade,
+    get_chat_model,
+    get_valid_json_response,
+)
 from biagent.utils.logger import biagent_logger as logger
 from biagent.utils.output_parser import parse_json_markdown
 
@@ -30,12 +38,24 @@ class GeoMetadataExtraction(BaseTool):
 
     def __init__(
         self,
-        llm: str | dict | BaseChatModel,
+        llm: str | dict | BaseChatModel | ModelCascade | None,
         meta_field_groups: list[MetaFieldList] | None = None,
         cfg: dict | None = {},
+        max_context_tokens: int = METADATA_TOKEN_BUDGET,
     ):
+        """
+        Args:
+            llm: the LLM or its config, a comma separated list of models builds a
+                cascade. None to only render the prompts and parse given replies,
+                e.g. of a batch job, without creating a client
+            meta_field_groups: the groups of fields extracted together, one prompt per
+                group
+            cfg: the tool config
+            max_context_tokens: the token budget of the sample metadata in each prompt
+        """
         super().__init__(cfg)
-        self.llm = get_chat_model(llm)
+        self.max_context_tokens = max_context_tokens
+        self.llm = get_chat_model(llm) if llm is not None else None
         if meta_field_groups:
             self.meta_field_groups = meta_field_groups
         else:
@@ -49,65 +69,34 @@ class GeoMetadataExtraction(BaseTool):
             self.meta_field_groups = [MetaFieldList(root=g) for g in meta_field_groups]
 
         self.umls_mapper = geo_helpers.UMLSMapper(threshold=0.5)
-
-    def _get_metadata_as_string(self, gsm: GSM, max_tokens: int = 1000):
-        """Get the metadata as SOFT formatted string."""
-        metalist = []
-        for metaname, meta in gsm.metadata.items():
-            assert isinstance(
-                meta, list
-            ), "Single value in metadata dictionary should be a list!"
-            for data in meta:
-                if data:
-                    meta_str = "!%s_%s = %s" % (
-                        gsm.geotype.capitalize(),
-                        metaname,
-                        data,
-                    )
-                    if count_tokens(meta_str) < max_tokens:
-                        metalist.append(meta_str)
-                    else:
-                        logger.error(
-                            f"Metadata `{metaname}` is too long. Likely a unhelpful field. Skip it."
-                        )
-        return "\n".join(metalist)
+        self._response_formats: dict[tuple, str] = {}
 
     def _construct_context(
-        self, gsm: GSM, gse: GSE, refs: list[str] | None = None
+        self, view: geo_helpers.SampleMetadataView, refs: list[str] | None = None
     ) -> str:
-        metadata_field_content = []
-        metadata_str = ""
-        if refs is None:
-            refs = []
-        for ref_field in refs:
-            if ref_field.startswith("Sample_"):
-                for field in gsm.metadata:
-                    if ref_field.replace("Sample_", "") in field:
-                        metadata_field_content.append(gsm.get_metadata_attribute(field))
-                        metadata_str += (
-                            f"{ref_field} = {gsm.get_metadata_attribute(field)}\n"
-                        )
-            elif gse is not None and ref_field.startswith("Series_"):
-                for field in gse.metadata:
-                    if ref_field.replace("Series_", "") in field:
-                        metadata_field_content.append(gse.get_metadata_attribute(field))
-                        metadata_str += (
-                            f"{ref_field} = {gse.get_metadata_attribute(field)}\n"
-                        )
+        metadata_str = view.ref_context(refs) if refs else ""
         if metadata_str == "":
-            metadata_str = self._get_metadata_as_string(gsm)
-            # adding some necessary GSE metadata
-            for field in ["title", "overall_design", "supplementary_file"]:
-                try:
-                    metadata_str += (
-                        f"!Series_{field} = {gse.get_metadata_attribute(field)}\n"
-                    )
-                except NoMetadataException:
-                    continue
+            metadata_str = view.context(max_tokens=self.max_context_tokens)
         return metadata_str
 
-    def _construct_response_format(self, meta_field_group: MetaFieldList) -> str:
+    def _construct_response_format(
+        self, meta_field_group: MetaFieldList, ask_confidence: bool = False
+    ) -> str:
+        # built once per field group, the prompts of a group then share a static
+        # prefix that the server can cache
+        key = (tuple(f.name for f in meta_field_group.root), ask_confidence)
+        if key not in self._response_formats:
+            self._response_formats[key] = self._build_response_format(
+                meta_field_group, ask_confidence
+            )
+        return self._response_formats[key]
+
+    def _build_response_format(
+        self, meta_field_group: MetaFieldList, ask_confidence: bool
+    ) -> str:
         response_fields_str = ""
+        if ask_confidence:
+            response_fields_str += '  "confidence": float, \\ how confident you are in this answer, from 0 to 1\n'
         for i, meta_field in enumerate(meta_field_group.root):
             note_str = ""
             note_str += meta_field.description
@@ -125,19 +114,51 @@ class GeoMetadataExtraction(BaseTool):
                 )
         return "```json\n{\n" + response_fields_str + "\n}\n```\n"
 
-    def parse_gsm(self, gsm: GSM, gse: GSE) -> dict:
+    def render_prompts(
+        self,
+        gsm: GSM,
+        gse: GSE,
+        adata: AnnData | None = None,
+        view: geo_helpers.SampleMetadataView | None = None,
+    ) -> tuple[dict, list[tuple[int, MetaFieldList, str]]]:
         """
-        Parse the metadata of a GSM and return a dictionary.
+        Fill the fields that need no LLM and render the prompts of the other groups.
 
         Args:
             gsm: GSM object
             gse: GSE object
+            adata: the count matrix of the sample, if loaded. Fields marked with
+                `infer_from_matrix` are then inferred from it instead of the LLM
+            view: the indexed metadata of the sample, built from `gsm` and `gse` if
+                not given
         Returns:
-            dict: dictionary of metadata
+            tuple: the fields filled so far, and the index, fields and prompt of each
+                group that needs the LLM. The group index is stable across runs
         """
-        final = {"gsm": gsm.get_accession()}
+        if view is None:
+            view = geo_helpers.SampleMetadataView(gsm, gse)
+        final = {"gsm": view.accession}
+        expression_type = infer_expression_type(adata) if adata is not None else None
+        if expression_type == UNKNOWN:
+            # the fields are left to the LLM
+            expression_type = None
+        llm_groups = []
 
-        for meta_field_group in self.meta_field_groups:
+        for group_index, meta_field_group in enumerate(self.meta_field_groups):
+            if expression_type is not None:
+                inferred_fields = [
+                    f for f in meta_field_group.root if f.infer_from_matrix
+                ]
+                for meta_field in inferred_fields:
+                    final[meta_field.name] = expression_type
+                if inferred_fields:
+                    meta_field_group = MetaFieldList(
+                        root=[
+                            f for f in meta_field_group.root if not f.infer_from_matrix
+                        ]
+                    )
+                    if len(meta_field_group.root) == 0:
+                        continue
             if (
                 len(meta_field_group.root) == 1
                 and meta_field_group.root[0].copy_from_ref
@@ -145,17 +166,10 @@ class GeoMetadataExtraction(BaseTool):
             ):
                 meta_field = meta_field_group.root[0]
                 # just copy the value from the metadata field!
-                try:
-                    if meta_field.ref[0].startswith("Series_"):
-                        final[meta_field.name] = gse.get_metadata_attribute(
-                            meta_field.ref[0].replace("Series_", "")
-                        )
-                    else:
-                        final[meta_field.name] = gsm.get_metadata_attribute(
-                            meta_field.ref[0].replace("Sample_", "")
-                        )
-                except NoMetadataException:
-                    final[meta_field.name] = None
+                ref = meta_field.ref[0]
+                if not ref.startswith(("Series_", "Sample_")):
+                    ref = f"Sample_{ref}"
+                final[meta_field.name] = view.get(ref)
                 if isinstance(final[meta_field.name], list):
                     final[meta_field.name] = ";".join(final[meta_field.name])
             else:
@@ -165,36 +179,85 @@ class GeoMetadataExtraction(BaseTool):
                     )
                 else:
                     refs = None
-                context_str = self._construct_context(gsm, gse, refs)
-                response_fields_str = self._construct_response_format(meta_field_group)
+                context_str = self._construct_context(view, refs)
+                response_fields_str = self._construct_response_format(
+                    meta_field_group, ask_confidence=isinstance(self.llm, ModelCascade)
+                )
                 prompt = prompts.metadata.render(
                     metadata=context_str, response_fields=response_fields_str
                 )
-                try:
-                    step_reply = self.llm.chat(prompt)
-                    if "Error" in step_reply:
-                        raise ValueError(f"Error parsing metadata: {step_reply}")
-                    parsed_meta_with_ref = parse_json_markdown(step_reply)
-                    for meta_field in meta_field_group.root:
-                        if meta_field.name in parsed_meta_with_ref:
-                            final[meta_field.name] = parsed_meta_with_ref[
-                                meta_field.name
-                            ]
-                            if meta_field.map_to_umls:
-                                final[meta_field.name + "_umls"] = self.umls_mapper(
-                                    parsed_meta_with_ref[meta_field.name]
-                                )
-                        else:
-                            final[meta_field.name] = None
-
-                except KeyboardInterrupt as exce:
-                    raise KeyboardInterrupt from exce
-                except Exception as e:
-                    logger.error(f"Error parsing metadata: {e}")
-                    for meta_field in meta_field_group.root:
-                        final[meta_field.name] = None
-
-        final["raw_metadata"] = self._get_metadata_as_string(gsm)
+                llm_groups.append((group_index, meta_field_group, prompt))
+        return final, llm_groups
+
+    def _fill_fields(
+        self, final: dict, meta_field_group: MetaFieldList, parsed: dict | None
+    ) -> None:
+        for meta_field in meta_field_group.root:
+            if parsed is not None and meta_field.name in parsed:
+                final[meta_field.name] = parsed[meta_field.name]
+                if meta_field.map_to_umls:
+                    final[meta_field.name + "_umls"] = self.umls_mapper(
+                        parsed[meta_field.name]
+                    )
+            else:
+                final[meta_field.name] = None
+
+    def parse_gsm(
+        self,
+        gsm: GSM,
+        gse: GSE,
+        adata: AnnData | None = None,
+        replies: dict[int, str] | None = None,
+    ) -> dict:
+        """
+        Parse the metadata of a GSM and return a dictionary.
+
+        Args:
+            gsm: GSM object
+            gse: GSE object
+            adata: the count matrix of the sample, if loaded. Fields marked with
+                `infer_from_matrix` are then inferred from it instead of the LLM
+            replies: the LLM replies by group index, e.g. from a batch job. The LLM
+                is called if None, groups without a reply are set to None
+        Returns:
+            dict: dictionary of metadata
+        """
+        if replies is None and self.llm is None:
+            raise ValueError("An LLM is needed to parse a GSM without replies")
+        # indexed once, shared by the prompts of all the groups and the raw metadata
+        view = geo_helpers.SampleMetadataView(gsm, gse)
+        final, llm_groups = self.render_prompts(gsm, gse, adata=adata, view=view)
+
+        for group_index, meta_field_group, prompt in llm_groups:
+            required_fields = [f.name for f in meta_field_group.root if f.required]
+
+            def accept(response: dict) -> bool:
+                # escalate to the next model if a required field is missing
+                return all(response.get(f) is not None for f in required_fields)
+
+            try:
+                if replies is None:
+                    parsed_meta_with_ref = get_valid_json_response(
+                        prompt,
+                        self.llm,
+                        validator=lambda response: isinstance(response, dict),
+                        accept=accept,
+                    )
+                elif group_index in replies:
+                    parsed_meta_with_ref = parse_json_markdown(replies[group_index])
+                else:
+                    logger.error(f"No reply for group {group_index} of {final['gsm']}")
+                    parsed_meta_with_ref = None
+                self._fill_fields(final, meta_field_group, parsed_meta_with_ref)
+
+            except KeyboardInterrupt as exce:
+                raise KeyboardInterrupt from exce
+            except Exception as e:
+                logger.error(f"Error parsing metadata: {e}")
+                for meta_field in meta_field_group.root:
+                    final[meta_field.name] = None
+
+        final["raw_metadata"] = view.soft
         return final
 
     def call(self, params: str, **kwargs) -> str:
@@ -1,18 +1,39 @@
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+
 from joblib import Memory
 from modelscope_agent.llm.base import BaseChatModel
 from modelscope_agent.tools.base import BaseTool, register_tool
 
 from biagent import prompts
-from biagent.utils.llm_helpers import get_chat_model, get_valid_json_response
+from biagent.utils.llm_helpers import (
+    ModelCascade,
+    get_chat_model,
+    get_valid_json_response,
+)
 from biagent.utils.logger import biagent_logger as logger
 from biagent.utils.pipeline_helpers import (
     CellTypeToolMetadata,
+    ParagraphIndex,
     ParagraphRotator,
     Pipeline,
+    PipelineNode,
     ToolMetadata,
+    extract_methods_section,
 )
 
 
+@functools.lru_cache(maxsize=None)
+def _tool_fields(tool_type: type[ToolMetadata]) -> tuple[dict, ...]:
+    """The tool schema in the prompts, computed once so it stays byte-identical."""
+    return tuple(
+        {"name": field, "type": str(content.annotation).replace(" | None", "")}
+        for field, content in tool_type.model_fields.items()
+    )
+
+
 @register_tool("pipeline_extractor")
 class PipelineExtractor(BaseTool):
     description = "Extract the pipeline from a given paper"
@@ -28,16 +49,55 @@ class PipelineExtractor(BaseTool):
 
     def __init__(
         self,
-        llm: str | dict | BaseChatModel,
+        llm: str | dict | BaseChatModel | ModelCascade,
         cfg: dict | None = {},
         cache: bool = False,
+        cache_dir: str = ".cache",
+        retrieval_top_k: int | None = None,
+        max_workers: int = 1,
+        window_tokens: int | None = None,
+        methods_only: bool = True,
+        strategy: Literal["per_node", "single_pass"] = "per_node",
+        stream: bool = False,
     ):
+        """
+        Args:
+            llm: the LLM or its config, a comma separated list of models builds a
+                cascade that escalates from the first model on invalid or
+                low-confidence responses
+            cfg: the tool config
+            cache: whether to cache the LLM responses on disk
+            cache_dir: the directory of the LLM response cache
+            retrieval_top_k: if set, rank the paragraphs of the paper for each task
+                with BM25 and send only the top-k paragraphs in a single prompt,
+                instead of scanning the paper one paragraph per LLM call
+            max_workers: if larger than 1, extract the nodes of each topological layer
+                of the pipeline concurrently with this many threads
+            window_tokens: if set, pack as many consecutive paragraphs as fit in this
+                many tokens into each prompt, and ask for the index of the paragraph
+                describing the task
+            methods_only: only send the methods sections of the paper to the LLM,
+                falls back to the whole paper if no methods section is found
+            strategy: `per_node` scans the paper once per pipeline task, `single_pass`
+                walks the paper once and asks for all the tasks not extracted yet in
+                each prompt. `retrieval_top_k` and `max_workers` only apply to
+                `per_node`
+            stream: stream the LLM responses and stop them once a valid JSON object
+                has arrived
+        """
+        if strategy not in ("per_node", "single_pass"):
+            raise ValueError(f"Invalid strategy: {strategy}")
         super().__init__(cfg)
-        self.llm = get_chat_model(llm)
-        self.mem = Memory(location=".cache", verbose=0)
+        self.llm = get_chat_model(llm, stream_json=stream)
+        self.retrieval_top_k = retrieval_top_k
+        self.max_workers = max_workers
+        self.window_tokens = window_tokens
+        self.methods_only = methods_only
+        self.strategy = strategy
+        self.mem = Memory(location=cache_dir, verbose=0)
         if cache:
             self.get_valid_json_response = self.mem.cache(
-                get_valid_json_response, ignore=["llm", "validator"]
+                get_valid_json_response, ignore=["llm", "validator", "accept"]
             )
         else:
             self.get_valid_json_response = get_valid_json_response
@@ -58,84 +118,298 @@ class PipelineExtractor(BaseTool):
         else:
             raise ValueError(f"Invalid task type: {task_type}")
         while content.has_next():
-            paragraph = content.get()
+            if self.window_tokens is not None:
+                window = content.window(self.window_tokens)
+                paragraph = None
+            else:
+                window = None
+                paragraph = content.get()
             prompt = prompts.pipeline_extractor.render(
                 paragraph=paragraph,
+                paragraphs=window,
                 current_task_name=current_task_name,
                 current_task_dependencies=current_task_dependencies,
                 current_task_descendants=current_task_descendants,
                 tools_extracted=tools_extracted,
-                tool_fields=[
-                    {
-                        "name": field,
-                        "type": str(content.annotation).replace(" | None", ""),
-                    }
-                    for field, content in tool_type.model_fields.items()
-                ],
+                ask_confidence=isinstance(self.llm, ModelCascade),
+                tool_fields=_tool_fields(tool_type),
             )
 
             def validator(json_string: dict) -> bool:
                 for field in ["task_exists", "task_name"]:
                     if field not in json_string:
-                        return False
-                try:
-                    if json_string["task_exists"]:
-                        tool_type.model_validate(json_string["tool_info"])
-                    return True
-                except:
-                    return False
-
-            response = self.get_valid_json_response(
-                prompt, self.llm, validator=validator
-            )
+                        raise ValueError(f"The field `{field}` is missing")
+                if json_string["task_exists"]:
+                    if json_string["task_name"] != current_task_name:
+                        raise ValueError(
+                            f"`task_name` must be `{current_task_name}`, "
+                            f"got `{json_string['task_name']}`"
+                        )
+                    # the pydantic error names the invalid fields of `tool_info`
+                    tool_type.model_validate(json_string["tool_info"])
+                return True
+
+            try:
+                response = self.get_valid_json_response(
+                    prompt, self.llm, validator=validator
+                )
+            except ValueError as e:
+                # json.JSONDecodeError is a ValueError too, move on to the next paragraphs
+                logger.error(f"No valid response for {current_task_name}: {e}")
+                response = {"task_exists": False}
 
             if response["task_exists"] and response["task_name"] == current_task_name:
+                if window is not None:
+                    # move the cursor to the paragraph describing the task
+                    paragraph_index = response.get("paragraph_index")
+                    if isinstance(paragraph_index, int) and (
+                        1 <= paragraph_index <= len(window)
+                    ):
+                        content.index += paragraph_index - 1
                 return tool_type.model_validate(response["tool_info"])
+            elif window is not None:
+                content.index += len(window)
             else:
                 content.step()
 
-    def extract_pipeline(self, path: str, output_file: str = None):
-        with open(path, "r") as f:
-            paper_content = f.read()
+    def _retrieve(
+        self,
+        index: ParagraphIndex,
+        paragraphs: ParagraphRotator,
+        current_task_name: str,
+        neighbour_labels: list[str],
+    ) -> ParagraphRotator:
+        """
+        Merge the top-k paragraphs relevant to a task, in paper order, into one.
+        The task name is weighted twice as much as the labels of its neighbours.
+        """
+        query = " ".join([current_task_name, current_task_name] + neighbour_labels)
+        top = sorted(index.top_k(query, self.retrieval_top_k))
+        candidates = ["\n\n".join(paragraphs.paragraphs[i] for i in top)] if top else []
+        return ParagraphRotator.from_paragraphs(candidates)
 
-        ## we assume the above functionality has been implemented
-        methods_section = ParagraphRotator(paper_content, min_word_limit=200)
+    def _extract_node(
+        self,
+        pipeline: Pipeline,
+        node: PipelineNode,
+        methods_section: ParagraphRotator,
+        index: ParagraphIndex | None,
+        tools_extracted: list,
+    ) -> ToolMetadata | None:
+        current_task_name = node.name
+        current_task_dependencies = pipeline.predecessor_labels(node.id)
 
-        # step 2: let's load the pipeline and extract the tools and metadata
-        pipeline = Pipeline()
-        tools_extracted = []
+        current_task_descendants = pipeline.successor_labels(node.id)
+        if index is not None:
+            content = self._retrieve(
+                index,
+                methods_section,
+                current_task_name,
+                current_task_dependencies + current_task_descendants,
+            )
+        else:
+            content = methods_section
+        return self._extract_tool(
+            node.type,
+            current_task_name,
+            current_task_dependencies,
+            current_task_descendants,
+            content,
+            tools_extracted,
+        )
+
+    def _set_tool(
+        self,
+        pipeline: Pipeline,
+        node: PipelineNode,
+        tool: ToolMetadata,
+        tools_extracted: list,
+    ) -> None:
+        pipeline.set_node(node, tool)
+        logger.info(f"Extracted tool for {node.id}: {tool}")
+
+        tools_extracted.append({"task_name": node.name, **tool.model_dump()})
+
+    def _extract_serial(
+        self,
+        pipeline: Pipeline,
+        methods_section: ParagraphRotator,
+        index: ParagraphIndex | None,
+        tools_extracted: list,
+    ) -> None:
         for node in pipeline.iter_nodes():
             if node.tool_required:
                 last_index = methods_section.index
-                current_task_name = node.name
-                current_task_dependencies = pipeline.predecessor_labels(node.id)
-
-                current_task_descendants = pipeline.successor_labels(node.id)
-                tool = self._extract_tool(
-                    node.type,
-                    current_task_name,
-                    current_task_dependencies,
-                    current_task_descendants,
-                    methods_section,
-                    tools_extracted,
+                tool = self._extract_node(
+                    pipeline, node, methods_section, index, tools_extracted
                 )
 
                 if tool is None:
                     # reset the index
                     methods_section.index = last_index
                 else:
-                    pipeline.set_node(node, tool)
-                    logger.info(f"Extracted tool for {node.id}: {tool}")
+                    self._set_tool(pipeline, node, tool, tools_extracted)
 
-                    tools_extracted.append(
-                        {"task_name": node.name, **tool.model_dump()}
+    def _extract_layered(
+        self,
+        pipeline: Pipeline,
+        methods_section: ParagraphRotator,
+        index: ParagraphIndex | None,
+        tools_extracted: list,
+    ) -> None:
+        """
+        Extract the nodes of each topological layer concurrently. Every node scans the
+        paper with its own cursor, starting where the previous layers left off, and only
+        sees the tools extracted in the previous layers.
+        """
+        start = methods_section.index
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for layer in pipeline.iter_layers():
+                nodes = [node for node in layer if node.tool_required]
+                cursors = [methods_section.fork(start) for _ in nodes]
+                tools_so_far = list(tools_extracted)
+                futures = [
+                    executor.submit(
+                        self._extract_node,
+                        pipeline,
+                        node,
+                        cursor,
+                        index,
+                        tools_so_far,
+                    )
+                    for node, cursor in zip(nodes, cursors)
+                ]
+                for node, cursor, future in zip(nodes, cursors, futures):
+                    tool = future.result()
+                    if tool is not None:
+                        self._set_tool(pipeline, node, tool, tools_extracted)
+                        if index is None:
+                            start = max(start, cursor.index)
+
+    def _extract_single_pass(
+        self,
+        pipeline: Pipeline,
+        methods_section: ParagraphRotator,
+        tools_extracted: list,
+    ) -> None:
+        """
+        Walk the paper once, each prompt lists all the tasks without a tool yet and
+        the LLM returns the tools of any of them described in the paragraphs.
+        """
+        pending = {
+            node.id: node for node in pipeline.iter_nodes() if node.tool_required
+        }
+
+        def validator(json_string: dict) -> bool:
+            if not isinstance(json_string.get("tasks"), list):
+                raise ValueError("The field `tasks` must be a list")
+            for task in json_string["tasks"]:
+                if not isinstance(task, dict):
+                    raise ValueError(f"Each task must be an object, got {task}")
+                for field in ["task_id", "tool_info"]:
+                    if field not in task:
+                        raise ValueError(f"The field `{field}` is missing in {task}")
+                try:
+                    # the ids are sometimes returned as strings
+                    task["task_id"] = int(task["task_id"])
+                except (TypeError, ValueError):
+                    raise ValueError(
+                        f"`task_id` must be an integer, got `{task['task_id']}`"
                     )
+            return True
+
+        while methods_section.has_next() and pending:
+            if self.window_tokens is not None:
+                paragraphs = methods_section.window(self.window_tokens)
+            else:
+                paragraphs = [methods_section.get()]
+            prompt = prompts.pipeline_extractor_multi.render(
+                paragraphs=paragraphs,
+                tasks=[
+                    {
+                        "id": node.id,
+                        "name": node.name,
+                        "cell_type": node.type == "cell_type_process",
+                        "dependencies": pipeline.predecessor_labels(node.id),
+                    }
+                    for node in pending.values()
+                ],
+                tools_extracted=tools_extracted,
+                ask_confidence=isinstance(self.llm, ModelCascade),
+                tool_fields=_tool_fields(CellTypeToolMetadata),
+            )
+            try:
+                response = self.get_valid_json_response(
+                    prompt, self.llm, validator=validator
+                )
+            except ValueError as e:
+                # json.JSONDecodeError is a ValueError too, move on to the next paragraphs
+                logger.error(f"No valid response for the tasks {list(pending)}: {e}")
+                response = {"tasks": []}
+
+            unknown_ids = [
+                task["task_id"]
+                for task in response["tasks"]
+                if task["task_id"] not in pending
+            ]
+            if unknown_ids:
+                logger.warning(f"Ignoring the tools of unknown tasks: {unknown_ids}")
+            for task in response["tasks"]:
+                node = pending.get(task["task_id"])
+                if node is None or task["tool_info"] is None:
+                    continue
+                tool_type = (
+                    CellTypeToolMetadata
+                    if node.type == "cell_type_process"
+                    else ToolMetadata
+                )
+                try:
+                    tool = tool_type.model_validate(task["tool_info"])
+                except ValueError:
+                    logger.warning(f"Invalid tool info for {node.id}: {task}")
+                    continue
+                self._set_tool(pipeline, node, tool, tools_extracted)
+                del pending[node.id]
+            methods_section.index += len(paragraphs)
+
+    def extract_pipeline(self, path: str, output_file: str = None) -> list[dict]:
+        """
+        Extract the tools of each pipeline task from a paper in markdown.
+
+        Args:
+            path: path to the paper
+            output_file: if given, save the pipeline as html, png or json
+        Returns:
+            list[dict]: the extracted tools, one dictionary per task with its name
+        """
+        with open(path, "r") as f:
+            paper_content = f.read()
+
+        if self.methods_only:
+            paper_content = extract_methods_section(paper_content)
+        methods_section = ParagraphRotator(paper_content, min_word_limit=200)
+        index = (
+            ParagraphIndex(methods_section.paragraphs)
+            if self.retrieval_top_k is not None
+            else None
+        )
+
+        # step 2: let's load the pipeline and extract the tools and metadata
+        pipeline = Pipeline()
+        tools_extracted = []
+        if self.strategy == "single_pass":
+            self._extract_single_pass(pipeline, methods_section, tools_extracted)
+        elif self.max_workers > 1:
+            self._extract_layered(pipeline, methods_section, index, tools_extracted)
+        else:
+            self._extract_serial(pipeline, methods_section, index, tools_extracted)
 
         if output_file is not None:
             logger.info(f"Saving pipeline to {output_file}")
             pipeline.save(filename=output_file, save_as=output_file.split(".")[-1])
+        return tools_extracted
 
     def call(self, params: str, **kwargs) -> str:
         params = self._verify_args(params)
         path = params.get("parsed_paper")
-        return self.extract_pipeline(path)
+        return json.dumps(self.extract_pipeline(path), ensure_ascii=False)
@@ -17,6 +17,12 @@ class MetaField(BaseModel):
     copy_from_ref: Optional[bool] = False
     # if True, map the value to UMLS concepts
     map_to_umls: Optional[bool] = False
+    # if True, infer the value from the count matrix when one is available
+    # instead of asking the LLM
+    infer_from_matrix: Optional[bool] = False
+    # if True, a null value from a cheaper model of a cascade is escalated
+    # to the next model
+    required: Optional[bool] = False
 
 
 class MetaFieldList(RootModel):
@@ -0,0 +1,622 @@
+import csv
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Literal, Optional
+
+import h5py
+import numpy as np
+import pandas as pd
+import scanpy as sc
+import scipy.sparse
+from pydantic import BaseModel
+from scanpy import AnnData
+
+from biagent.utils.logger import biagent_logger as logger
+
+# labels used for the `expression calculation in the supplementary files` field
+READ_COUNT = "read count"
+# TPM also sums to one million per cell, without gene lengths it cannot be told
+# apart from CPM
+CPM_TPM = "CPM or TPM"
+TPM_FPKM = "TPM/FPKM"
+LOG_TRANSFORMED = "log transformed"
+UNKNOWN = "unknown"
+
+# values above this are very unlikely to come from log-transformed data
+_LOG_MAX_VALUE = 30.0
+# per-cell sums within this relative spread are considered constant
+_CONSTANT_SUM_RTOL = 0.02
+# the bases tried to invert log-transformed data, `log1p` first
+_LOG_BASES = {"natural log": np.e, "log2": 2.0}
+
+
+def _sample_rows(X, max_rows: int, random_state: int):
+    n_rows = X.shape[0]
+    if n_rows <= max_rows:
+        return X[:]
+    rng = np.random.default_rng(random_state)
+    idx = np.sort(rng.choice(n_rows, size=max_rows, replace=False))
+    return X[idx]
+
+
+def _block_stats(block) -> tuple[np.ndarray, np.ndarray]:
+    """Return the stored values and per-row sums of a (sparse or dense) block."""
+    if scipy.sparse.issparse(block):
+        block = scipy.sparse.csr_matrix(block)
+        return block.data, np.asarray(block.sum(axis=1)).ravel()
+    block = np.asarray(block)
+    return block.ravel(), block.sum(axis=1)
+
+
+def _inverse_log(block, base: float):
+    """Undo `log(x + 1)` in the given base, returns the values and per-row sums."""
+    if scipy.sparse.issparse(block):
+        block = scipy.sparse.csr_matrix(block, dtype=np.float64, copy=True)
+        block.data = np.power(base, block.data) - 1
+        return block.data, np.asarray(block.sum(axis=1)).ravel()
+    block = np.power(base, np.asarray(block, dtype=np.float64)) - 1
+    return block.ravel(), block.sum(axis=1)
+
+
+def _is_integral(values: np.ndarray) -> bool:
+    # tolerate the rounding error of counts up to ~1e4 stored as float32 logs
+    return bool(np.all(np.abs(values - np.round(values)) <= 1e-2))
+
+
+def _has_constant_sum(sums: np.ndarray) -> bool:
+    sums = sums[sums > 0]
+    if len(sums) == 0:
+        return False
+    return bool(np.ptp(sums) <= _CONSTANT_SUM_RTOL * np.median(sums))
+
+
+def _scale_name(sums: np.ndarray) -> str:
+    scale = np.median(sums[sums > 0])
+    if np.isclose(scale, 1e6, rtol=_CONSTANT_SUM_RTOL):
+        return CPM_TPM
+    return f"normalized to {scale:.3g} per cell"
+
+
+def infer_expression_type(
+    adata: AnnData | np.ndarray | scipy.sparse.spmatrix,
+    max_cells: int = 500,
+    random_state: int = 0,
+) -> str:
+    """
+    Infer how the expression values of a count matrix were calculated.
+
+    Only a random block of `max_cells` cells is inspected. The values are checked for
+    integrality, range and constant per-cell sums (CPM and friends). Small values are
+    inverted as `log(x + 1)` in base e and 2, and the same checks tell log counts and
+    log normalized data apart. TPM also sums to one million per cell and cannot be
+    told apart from CPM without gene lengths, so both are reported as `CPM or TPM`.
+
+    Args:
+        adata: AnnData object or matrix with cells as rows
+        max_cells: the maximum number of cells to sample
+        random_state: seed of the cell sampling
+    Returns:
+        str: one of `read count`, `CPM or TPM`, `TPM/FPKM`, `unknown` or a
+            `log transformed` label
+    """
+    X = adata.X if isinstance(adata, AnnData) else adata
+    if X is None or X.shape[0] == 0 or X.shape[1] == 0:
+        return UNKNOWN
+    block = _sample_rows(X, max_cells, random_state)
+    values, sums = _block_stats(block)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return UNKNOWN
+
+    if values.min() < 0:
+        # centered/scaled values, only possible after a log transformation
+        return f"{LOG_TRANSFORMED} (scaled)"
+    if np.all(np.mod(values, 1) == 0):
+        return READ_COUNT
+    if values.max() <= _LOG_MAX_VALUE:
+        inverted = {
+            base_name: _inverse_log(block, base)
+            for base_name, base in _LOG_BASES.items()
+        }
+        for base_name, (_, log_sums) in inverted.items():
+            if _has_constant_sum(log_sums):
+                return f"{LOG_TRANSFORMED} ({_scale_name(log_sums)}, {base_name})"
+        for base_name, (log_values, _) in inverted.items():
+            if _is_integral(log_values[np.isfinite(log_values)]):
+                return f"{LOG_TRANSFORMED} ({READ_COUNT}, {base_name})"
+        return f"{LOG_TRANSFORMED} ({TPM_FPKM})"
+    if _has_constant_sum(sums):
+        return _scale_name(sums)
+    return TPM_FPKM
+
+
+def series_sample_mask(
+    obs_names: pd.Index, accession: str, title: str | None = None
+) -> np.ndarray:
+    """
+    Find the observations of a series-level matrix that belong to one sample.
+
+    An observation matches if its name contains the GSM accession, or if it equals the
+    sample title or starts with the title followed by a separator (e.g. `title_AAACCTG`).
+
+    Args:
+        obs_names: observation names of the series-level AnnData
+        accession: GSM accession of the sample
+        title: sample title
+    Returns:
+        np.ndarray: boolean mask over the observations
+    """
+    obs_names = pd.Index(obs_names).astype(str)
+    mask = obs_names.str.contains(
+        rf"(?:^|[^0-9A-Za-z]){re.escape(accession)}(?![0-9])", regex=True
+    )
+    if title:
+        mask |= obs_names.str.contains(
+            rf"^{re.escape(title)}(?:$|[_\-:.#|])", regex=True
+        )
+    return np.asarray(mask, dtype=bool)
+
+
+_checksums: dict[tuple[str, int, int], str] = {}
+_checksums_lock = threading.Lock()
+
+
+def checksum_path(path: str) -> str:
+    """The hidden file next to `path` that keeps its checksum across processes."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.sha256")
+
+
+def _read_checksum_file(path: str, stat: os.stat_result) -> str | None:
+    try:
+        with open(checksum_path(path), "r") as f:
+            size, mtime_ns, checksum = f.read().split()
+    except (OSError, ValueError):
+        return None
+    if int(size) != stat.st_size or int(mtime_ns) != stat.st_mtime_ns:
+        return None
+    return checksum
+
+
+def _write_checksum_file(path: str, stat: os.stat_result, checksum: str) -> None:
+    target = checksum_path(path)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{stat.st_size} {stat.st_mtime_ns} {checksum}\n")
+        os.replace(tmp_path, target)
+    except OSError as e:
+        # a read-only folder, the checksum is computed again by the next process
+        logger.warning(f"Cannot save the checksum of {path}: {e}")
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    SHA-256 of a file, memoized per (path, size, mtime) within the process and saved
+    next to the file, see `checksum_path`, so that the file is read once per version.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _checksums_lock:
+        if memo_key in _checksums:
+            return _checksums[memo_key]
+    checksum = _read_checksum_file(path, stat)
+    if checksum is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        checksum = digest.hexdigest()
+        _write_checksum_file(path, stat, checksum)
+    with _checksums_lock:
+        _checksums[memo_key] = checksum
+    return checksum
+
+
+class AnnDataCache:
+    """
+    On-disk cache of count matrices stored as h5ad files.
+
+    Entries are keyed by the GEO accession, the checksums of its supplementary files and
+    the version of the reader code, so that a new download or a change of the reader
+    invalidates them. Entries can be opened in backed mode to query them without loading
+    the whole matrix.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, accession: str, files: list[str], reader_version: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(accession.encode())
+        for checksum in sorted(file_checksum(f) for f in files):
+            digest.update(checksum.encode())
+        digest.update(reader_version.encode())
+        return digest.hexdigest()[:32]
+
+    def path(self, accession: str, key: str) -> str:
+        return os.path.join(self.cache_dir, accession, f"{key}.h5ad")
+
+    def get(self, accession: str, key: str, backed: bool = False) -> AnnData | None:
+        path = self.path(accession, key)
+        if not os.path.isfile(path):
+            return None
+        logger.info(f"Loading cached count matrix of {accession} from {path}")
+        return sc.read_h5ad(path, backed="r" if backed else None)
+
+    def put(self, accession: str, key: str, adata: AnnData) -> str:
+        path = self.path(accession, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(suffix=".h5ad", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            adata.write_h5ad(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+class CountMatrixSelection(BaseModel):
+    """
+    The part of a count matrix to materialize. Genes match gene symbols or gene IDs,
+    cells match barcodes, `obs_filter` is a `pandas.DataFrame.query` over `adata.obs`.
+    """
+
+    genes: Optional[list[str]] = None
+    cells: Optional[list[str]] = None
+    obs_filter: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return self.genes is None and self.cells is None and self.obs_filter is None
+
+    def obs_mask(self, obs: pd.DataFrame) -> np.ndarray:
+        mask = np.ones(len(obs), dtype=bool)
+        if self.cells is not None:
+            mask &= np.asarray(obs.index.astype(str).isin(self.cells))
+        if self.obs_filter is not None:
+            mask &= np.asarray(obs.index.isin(obs.query(self.obs_filter).index))
+        return mask
+
+    def var_mask(self, var: pd.DataFrame) -> np.ndarray:
+        mask = np.ones(len(var), dtype=bool)
+        if self.genes is not None:
+            mask = np.asarray(var.index.astype(str).isin(self.genes))
+            for col in var.columns:
+                if pd.api.types.is_string_dtype(
+                    var[col]
+                ) or pd.api.types.is_object_dtype(var[col]):
+                    mask |= np.asarray(var[col].astype(str).isin(self.genes))
+        return mask
+
+    def apply(self, adata: AnnData) -> AnnData:
+        """Subset an in-memory or backed AnnData, returns an in-memory copy."""
+        if self.is_empty():
+            return adata.to_memory() if adata.isbacked else adata
+        view = adata[self.obs_mask(adata.obs), self.var_mask(adata.var)]
+        return view.to_memory() if adata.isbacked else view.copy()
+
+
+# decompressed copies of the gzipped HDF5 files, kept out of the supplementary folders
+DECOMPRESSED_DIR = os.path.join(tempfile.gettempdir(), "biagent_decompressed")
+
+
+def _decompressed(path: str) -> str:
+    """
+    Decompress a `.gz` file once into `DECOMPRESSED_DIR` and return the new path. The
+    copy is named after the full path of the source, and redone if the source changed.
+    """
+    if not path.endswith(".gz"):
+        return path
+    source = os.path.abspath(path)
+    digest = hashlib.sha1(source.encode()).hexdigest()[:16]
+    new_path = os.path.join(
+        DECOMPRESSED_DIR, f"{digest}_{os.path.basename(source).removesuffix('.gz')}"
+    )
+    if not os.path.isfile(new_path) or os.path.getmtime(new_path) < os.path.getmtime(
+        source
+    ):
+        os.makedirs(DECOMPRESSED_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=DECOMPRESSED_DIR)
+        with gzip.open(source, "rb") as f_in, os.fdopen(fd, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(tmp_path, new_path)
+    return new_path
+
+
+def _index_lookup(names: pd.Index, selected: np.ndarray) -> np.ndarray:
+    """Map old positions to positions in the selection, -1 for dropped entries."""
+    lookup = np.full(len(names), -1, dtype=np.int64)
+    lookup[selected] = np.arange(len(selected))
+    return lookup
+
+
+def read_mtx(
+    mtx_path: str,
+    barcodes_path: str,
+    features_path: str,
+    genes: list[str] | None = None,
+    cells: list[str] | None = None,
+    chunksize: int = 5_000_000,
+) -> AnnData:
+    """
+    Read a Matrix Market count matrix with its barcodes and features files.
+
+    The triplets are streamed in chunks and only those of the selected genes and
+    cells are kept, so the full matrix is never materialized.
+
+    Args:
+        mtx_path: path to the `.mtx` (or `.mtx.gz`) file
+        barcodes_path: path to the barcodes file, one cell per line
+        features_path: path to the features/genes file, gene IDs and/or symbols
+        genes: gene symbols or IDs to keep, all genes if None
+        cells: barcodes to keep, all cells if None
+        chunksize: the number of triplets read at a time
+    Returns:
+        AnnData: cells by genes matrix
+    """
+    barcodes = pd.read_csv(barcodes_path, sep="\t", header=None, dtype=str)
+    features = pd.read_csv(features_path, sep="\t", header=None, dtype=str)
+    obs = pd.DataFrame(index=pd.Index(barcodes[0].values, name="cell_id"))
+    symbol_col = 1 if features.shape[1] > 1 else 0
+    var = pd.DataFrame(index=pd.Index(features[symbol_col].values, name="gene_names"))
+    if features.shape[1] > 1:
+        var["gene_ids"] = features[0].values
+
+    selection = CountMatrixSelection(genes=genes, cells=cells)
+    cell_idx = np.flatnonzero(selection.obs_mask(obs))
+    gene_idx = np.flatnonzero(selection.var_mask(var))
+    cell_lookup = _index_lookup(obs.index, cell_idx)
+    gene_lookup = _index_lookup(var.index, gene_idx)
+
+    open_func = gzip.open if mtx_path.endswith(".gz") else open
+    header_lines = 0
+    with open_func(mtx_path, "rt") as f:
+        for line in f:
+            header_lines += 1
+            if not line.startswith("%"):
+                n_rows, n_cols, _ = (int(x) for x in line.split())
+                break
+    # 10x writes genes as rows, other tools write cells as rows
+    genes_as_rows = n_rows == len(var) and n_cols == len(obs)
+
+    rows, cols, values = [], [], []
+    for chunk in pd.read_csv(
+        mtx_path,
+        sep=r"\s+",
+        header=None,
+        skiprows=header_lines,
+        chunksize=chunksize,
+        dtype={0: np.int64, 1: np.int64, 2: np.float32},
+    ):
+        triplets = chunk.to_numpy()
+        row, col = (
+            triplets[:, 0].astype(np.int64) - 1,
+            triplets[:, 1].astype(np.int64) - 1,
+        )
+        if genes_as_rows:
+            row, col = col, row
+        new_row, new_col = cell_lookup[row], gene_lookup[col]
+        keep = (new_row >= 0) & (new_col >= 0)
+        rows.append(new_row[keep])
+        cols.append(new_col[keep])
+        values.append(triplets[keep, 2].astype(np.float32))
+
+    X = scipy.sparse.coo_matrix(
+        (
+            np.concatenate(values) if values else np.empty(0, dtype=np.float32),
+            (
+                np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+                np.concatenate(cols) if cols else np.empty(0, dtype=np.int64),
+            ),
+        ),
+        shape=(len(cell_idx), len(gene_idx)),
+    ).tocsr()
+    adata = AnnData(X=X, obs=obs.iloc[cell_idx], var=var.iloc[gene_idx])
+    adata.obs_names_make_unique()
+    adata.var_names_make_unique()
+    return adata
+
+
+def _contiguous_runs(idx: np.ndarray) -> list[tuple[int, int]]:
+    """Split sorted indices into [start, end) runs of consecutive values."""
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(idx)]])
+    return [(int(idx[s]), int(idx[e - 1]) + 1) for s, e in zip(starts, ends)]
+
+
+def read_10x_h5(
+    path: str,
+    genes: list[str] | None = None,
+    cells: list[str] | None = None,
+) -> AnnData:
+    """
+    Read a 10x Genomics HDF5 count matrix (v2 or v3 layout).
+
+    The matrix is stored per cell (CSC), so only the hyperslabs of the selected cells
+    are read from disk, and the selected genes are filtered from those.
+
+    Args:
+        path: path to the `.h5` file
+        genes: gene symbols or IDs to keep, all genes if None
+        cells: barcodes to keep, all cells if None
+    Returns:
+        AnnData: cells by genes matrix
+    """
+    with h5py.File(_decompressed(path), "r") as f:
+        group = f["matrix"] if "matrix" in f else f[list(f.keys())[0]]
+        if "features" in group:
+            gene_names = group["features/name"][:].astype(str)
+            gene_ids = group["features/id"][:].astype(str)
+        else:
+            gene_names = group["gene_names"][:].astype(str)
+            gene_ids = group["genes"][:].astype(str)
+        obs = pd.DataFrame(
+            index=pd.Index(group["barcodes"][:].astype(str), name="cell_id")
+        )
+        var = pd.DataFrame(
+            {"gene_ids": gene_ids}, index=pd.Index(gene_names, name="gene_names")
+        )
+
+        selection = CountMatrixSelection(genes=genes, cells=cells)
+        cell_idx = np.flatnonzero(selection.obs_mask(obs))
+        gene_idx = np.flatnonzero(selection.var_mask(var))
+        gene_lookup = _index_lookup(var.index, gene_idx)
+
+        indptr = group["indptr"][:]
+        data, indices, counts = [], [], []
+        for start, end in _contiguous_runs(cell_idx):
+            lo, hi = indptr[start], indptr[end]
+            run_indices = gene_lookup[group["indices"][lo:hi]]
+            run_data = group["data"][lo:hi]
+            keep = run_indices >= 0
+            # number of kept entries per cell of the run
+            cell_of_entry = np.repeat(
+                np.arange(end - start), np.diff(indptr[start : end + 1])
+            )
+            counts.append(np.bincount(cell_of_entry[keep], minlength=end - start))
+            indices.append(run_indices[keep])
+            data.append(run_data[keep].astype(np.float32))
+
+    new_indptr = (
+        np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+        if counts
+        else np.zeros(1, dtype=np.int64)
+    )
+    X = scipy.sparse.csr_matrix(
+        (
+            np.concatenate(data) if data else np.empty(0, dtype=np.float32),
+            np.concatenate(indices) if indices else np.empty(0, dtype=np.int64),
+            new_indptr,
+        ),
+        shape=(len(cell_idx), len(gene_idx)),
+    )
+    adata = AnnData(X=X, obs=obs.iloc[cell_idx], var=var.iloc[gene_idx])
+    adata.obs_names_make_unique()
+    adata.var_names_make_unique()
+    return adata
+
+
+def read_h5ad(path: str, selection: CountMatrixSelection | None = None) -> AnnData:
+    """
+    Read an h5ad file, only the selected cells and genes are loaded from disk.
+    """
+    adata = sc.read_h5ad(_decompressed(path), backed="r")
+    if selection is None:
+        selection = CountMatrixSelection()
+    return selection.apply(adata)
+
+
+def _read_header(path: str, sep: str | None) -> tuple[str, list[str], list[str]]:
+    """Return the delimiter, the header fields and the fields of the first data row."""
+    open_func = gzip.open if path.endswith(".gz") else open
+    with open_func(path, "rt") as f:
+        header = f.readline().rstrip("\r\n")
+        first = f.readline().rstrip("\r\n")
+    if sep is None:
+        if "\t" in header:
+            sep = "\t"
+        elif "," in header:
+            sep = ","
+        else:
+            sep = r"\s+"
+    if sep == r"\s+":
+        return sep, header.split(), first.split()
+    header, first = csv.reader([header, first], delimiter=sep)
+    return sep, header, first
+
+
+def read_table_sparse(
+    path: str,
+    orientation: Literal["gene_by_cell", "cell_by_gene"] = "gene_by_cell",
+    index_col: int | str = 0,
+    chunksize: int = 1000,
+    dtype: str | np.dtype = np.float32,
+    sep: str | None = None,
+    drop_columns: list[str] | None = None,
+    genes: list[str] | None = None,
+    cells: list[str] | None = None,
+) -> AnnData:
+    """
+    Stream a delimited count table into a CSR matrix.
+
+    The table is read `chunksize` rows at a time, each chunk is converted to a sparse
+    block right away, so the dense table is never held in memory.
+
+    Args:
+        path: path to the table, may be gzipped
+        orientation: `gene_by_cell` if genes are rows, `cell_by_gene` if cells are rows
+        index_col: position or name of the column with the row names
+        chunksize: the number of rows read at a time
+        dtype: dtype of the matrix, e.g. `float32` or `int32`
+        sep: the delimiter, inferred from the header if None
+        drop_columns: names of non-count columns to skip, e.g. gene descriptions
+        genes: gene names to keep, all genes if None
+        cells: cell IDs to keep, all cells if None
+    Returns:
+        AnnData: cells by genes matrix
+    """
+    sep, header, first = _read_header(path, sep)
+    if len(header) == len(first) - 1:
+        # R style tables have no header field for the row names
+        header = [""] + header
+    index_pos = index_col if isinstance(index_col, int) else header.index(index_col)
+    drop_columns = set(drop_columns or [])
+    gene_by_cell = orientation == "gene_by_cell"
+    column_selection, row_selection = (cells, genes) if gene_by_cell else (genes, cells)
+    column_selection = set(column_selection) if column_selection is not None else None
+    row_selection = set(row_selection) if row_selection is not None else None
+
+    data_pos = [
+        i
+        for i, name in enumerate(header)
+        if i != index_pos
+        and name not in drop_columns
+        and (column_selection is None or name in column_selection)
+    ]
+
+    row_names, blocks = [], []
+    for chunk in pd.read_csv(
+        path,
+        sep=sep,
+        header=None,
+        skiprows=1,
+        usecols=[index_pos] + data_pos,
+        dtype={index_pos: str, **{i: np.float32 for i in data_pos}},
+        chunksize=chunksize,
+    ):
+        names = chunk[index_pos].astype(str)
+        if row_selection is not None:
+            keep = names.isin(row_selection).to_numpy()
+            chunk, names = chunk[keep], names[keep]
+        values = np.nan_to_num(chunk[data_pos].to_numpy(dtype=np.float32))
+        blocks.append(scipy.sparse.csr_matrix(values.astype(dtype, copy=False)))
+        row_names.extend(names)
+
+    X = scipy.sparse.vstack(blocks, format="csr") if blocks else None
+    if X is None:
+        X = scipy.sparse.csr_matrix((0, len(data_pos)), dtype=dtype)
+    row_index = pd.Index(row_names)
+    column_index = pd.Index([header[i] for i in data_pos])
+    if gene_by_cell:
+        X = X.T.tocsr()
+        row_index, column_index = column_index, row_index
+    adata = AnnData(
+        X=X,
+        obs=pd.DataFrame(index=row_index.rename("cell_id")),
+        var=pd.DataFrame(index=column_index.rename("gene_names")),
+    )
+    adata.obs_names_make_unique()
+    adata.var_names_make_unique()
+    return adata
@@ -1,3 +1,4 @@
+import functools
 import gzip
 import os
 import shutil
@@ -10,13 +11,18 @@ import h5py
 import requests
 import scipy
 from bs4 import BeautifulSoup
-from GEOparse.GEOTypes import GSE, GSM
+from GEOparse.GEOTypes import GSE, GSM, NoMetadataException
+from GEOparse.utils import download_from_url
+from modelscope_agent.utils.tokenization_utils import count_tokens
 from scispacy.candidate_generation import CandidateGenerator
 
+from biagent.configs.metadata import METADATA_FIELD_PRIORITY
 from biagent.types import FileType
 from biagent.utils.logger import biagent_logger as logger
 
 GEO_PATH = tempfile.gettempdir()
+# the series fields added to the metadata of a sample
+SERIES_CONTEXT_FIELDS = ["title", "overall_design", "supplementary_file"]
 GEO_BASE_URL = "https://www.ncbi.nlm.nih.gov"
 BASE_HEADER = {
     "authority": "www.ncbi.nlm.nih.gov",
@@ -161,6 +167,131 @@ class UMLSMapper:
             return disease
 
 
+# the metadata of the samples of a series share most of their lines
+_count_tokens = functools.lru_cache(maxsize=65536)(count_tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def _field_priority(field: str) -> int:
+    for i, prefix in enumerate(METADATA_FIELD_PRIORITY):
+        if field.startswith(prefix):
+            return i
+    return len(METADATA_FIELD_PRIORITY)
+
+
+class SampleMetadataView:
+    """
+    The metadata of a sample and its series, indexed and rendered as SOFT lines once,
+    then shared by the prompts of all the field groups. `soft` is the full rendering
+    of the sample reported as its raw metadata.
+    """
+
+    def __init__(self, gsm: GSM, gse: GSE | None = None):
+        self.accession = gsm.get_accession()
+        # `Sample_<name>` and `Series_<name>` to the values of the field
+        self.fields: dict[str, list] = {}
+        for geo in (gsm, gse):
+            if geo is not None:
+                prefix = geo.geotype.capitalize()
+                for metaname, meta in geo.metadata.items():
+                    assert isinstance(
+                        meta, list
+                    ), "Single value in metadata dictionary should be a list!"
+                    self.fields[f"{prefix}_{metaname}"] = meta
+
+        # the field and SOFT line of each distinct value of a field, the sample lines
+        # first. Only repeated values of the same field are dropped, the same value
+        # under two fields, e.g. a title and a source name, says different things
+        self.lines: list[tuple[str, str]] = []
+        seen = set()
+
+        def add_lines(fields: list[str]):
+            for field in fields:
+                for data in self.fields.get(field, []):
+                    value = " ".join(str(data).split()).casefold()
+                    if value and (field, value) not in seen:
+                        seen.add((field, value))
+                        self.lines.append((field, f"!{field} = {data}"))
+
+        sample_fields = [f for f in self.fields if f.startswith("Sample_")]
+        add_lines(sample_fields)
+        # the raw metadata keeps every value of the sample, repeated ones included
+        self.soft = "\n".join(
+            f"!{field} = {data}"
+            for field in sample_fields
+            for data in self.fields[field]
+            if data
+        )
+        if gse is not None:
+            # adding some necessary GSE metadata
+            add_lines([f"Series_{name}" for name in SERIES_CONTEXT_FIELDS])
+        self._contexts: dict[int | None, str] = {}
+        self._ref_contexts: dict[tuple, str] = {}
+
+    @functools.cached_property
+    def token_counts(self) -> list[int]:
+        """The tokens of each line, including its line break."""
+        return [_count_tokens(line) + 1 for _, line in self.lines]
+
+    def get(self, field: str) -> str | list | None:
+        """
+        The value of a field such as `Sample_title`, a list if it has several values,
+        None if it is missing.
+        """
+        values = self.fields.get(field)
+        if not values:
+            return None
+        return values[0] if len(values) == 1 else values
+
+    def context(self, max_tokens: int | None = None) -> str:
+        """
+        The SOFT lines of the sample and the series design. With `max_tokens`, the
+        lines are picked by field priority until the budget is used up, and kept in
+        their original order.
+        """
+        if max_tokens in self._contexts:
+            return self._contexts[max_tokens]
+        if max_tokens is None:
+            kept = range(len(self.lines))
+        else:
+            budget = max_tokens
+            kept = set()
+            skipped = set()
+            for i in sorted(
+                range(len(self.lines)), key=lambda i: _field_priority(self.lines[i][0])
+            ):
+                if self.token_counts[i] <= budget:
+                    kept.add(i)
+                    budget -= self.token_counts[i]
+                else:
+                    skipped.add(self.lines[i][0])
+            if skipped:
+                logger.warning(
+                    f"Metadata of {self.accession} exceeds the token budget, "
+                    f"skipped: {sorted(skipped)}"
+                )
+        self._contexts[max_tokens] = "\n".join(
+            line for i, (_, line) in enumerate(self.lines) if i in kept
+        )
+        return self._contexts[max_tokens]
+
+    def ref_context(self, refs: list[str]) -> str:
+        """The fields whose name contains one of the refs, e.g. `Sample_characteristics`."""
+        key = tuple(sorted(refs))
+        if key not in self._ref_contexts:
+            lines = []
+            for ref_field in key:
+                prefix, _, name = ref_field.partition("_")
+                for field in self.fields:
+                    if (
+                        field.startswith(prefix + "_")
+                        and name in field[len(prefix) + 1 :]
+                    ):
+                        lines.append(f"{ref_field} = {self.get(field)}\n")
+            self._ref_contexts[key] = "".join(lines)
+        return self._ref_contexts[key]
+
+
 def get_geo(geo_id, return_gse=False) -> GSM | tuple[GSM, GSE]:
     if return_gse:
         gsm = GEOparse.get_GEO(geo=geo_id, destdir=GEO_PATH, silent=True)
@@ -286,7 +417,54 @@ def _peek_file_content(filename: str, directory: str):
             return process_lines(f)
 
 
-def get_supp_data(gsm_id: str) -> dict:
+def _collect_supp_files(directory: str, peek: bool = True) -> dict:
+    """
+    Extract the archives in a downloaded supplementary folder and peek into every file.
+    """
+    res = {"files": os.listdir(directory), "dir": directory, "content": []}
+    new_files = []
+    for supp_file in res["files"]:
+        if ".tar" in supp_file:
+            file = tarfile.open(os.path.join(res["dir"], supp_file))
+            file.extractall(res["dir"])
+            file.close()
+
+            for cur_dir, _, cur_files in os.walk(res["dir"]):
+                if len(cur_files) > 0:
+                    for cur_file in cur_files:
+                        # hidden files such as the saved checksums are not data
+                        if cur_file == supp_file or cur_file.startswith("."):
+                            continue
+                        shutil.move(
+                            os.path.join(cur_dir, cur_file),
+                            os.path.join(res["dir"], cur_file),
+                        )
+                        new_files.append(cur_file)
+            new_files = list(set(new_files))  # remove duplicates
+        elif not supp_file.startswith(".") and os.path.isfile(
+            os.path.join(res["dir"], supp_file)
+        ):
+            new_files.append(supp_file)
+
+    res["files"] = new_files
+    if peek:
+        peek_supp_data(res)
+    return res
+
+
+def peek_supp_data(file_content: dict) -> dict:
+    """
+    Fill in the content of supplementary files collected with `peek=False`.
+    """
+    if len(file_content["content"]) != len(file_content["files"]):
+        file_content["content"] = [
+            _peek_file_content(supp_file, file_content["dir"])
+            for supp_file in file_content["files"]
+        ]
+    return file_content
+
+
+def get_supp_data(gsm_id: str, peek: bool = True) -> dict:
     res = {"files": [], "dir": None, "content": []}
     gsm = get_geo(gsm_id)
     logger.info("{} will download", gsm_id)
@@ -294,36 +472,52 @@ def get_supp_data(gsm_id: str) -> dict:
 
     for f in os.listdir(GEO_PATH):
         if os.path.isdir(os.path.join(GEO_PATH, f)) and (gsm_id in f):
-            res["files"] = os.listdir(os.path.join(GEO_PATH, f))
-            res["dir"] = os.path.join(GEO_PATH, f)
-            new_files = []
-            for gsm_file in res["files"]:
-                if ".tar" in gsm_file:
-                    file = tarfile.open(os.path.join(res["dir"], gsm_file))
-                    file.extractall(res["dir"])
-                    file.close()
-
-                    for cur_dir, _, cur_files in os.walk(res["dir"]):
-                        if len(cur_files) > 0:
-                            for cur_file in cur_files:
-                                if cur_file == gsm_file:
-                                    continue
-                                shutil.move(
-                                    os.path.join(cur_dir, cur_file),
-                                    os.path.join(res["dir"], cur_file),
-                                )
-                                new_files.append(cur_file)
-                    new_files = list(set(new_files))  # remove duplicates
-                elif os.path.isfile(os.path.join(res["dir"], gsm_file)):
-                    new_files.append(gsm_file)
-
-            res["files"] = new_files
-            for gsm_file in res["files"]:
-                res["content"].append(_peek_file_content(gsm_file, res["dir"]))
+            res = _collect_supp_files(os.path.join(GEO_PATH, f), peek=peek)
             break
     return res
 
 
+def get_series_supp_urls(gse: GSE) -> list[str]:
+    """
+    Return the series-level supplementary file URLs of a GSE.
+    The `_RAW.tar` archive only bundles the per-sample files and is skipped.
+    """
+    try:
+        urls = gse.get_metadata_attribute("supplementary_file")
+    except NoMetadataException:
+        return []
+    if isinstance(urls, str):
+        urls = [urls]
+    return [
+        url
+        for url in urls
+        if url.strip() and url.strip().upper() != "NONE" and "_RAW.tar" not in url
+    ]
+
+
+def get_series_supp_data(gse_id: str, peek: bool = True) -> dict:
+    """
+    Download the series-level supplementary files of a GSE (only once) and peek into them.
+    :param gse_id: a valid GEO series ID
+    :param peek: whether to peek into the files, see `peek_supp_data`
+    :return: a dictionary with the same layout as `get_supp_data`
+    """
+    res = {"files": [], "dir": None, "content": []}
+    gse = get_geo(gse_id)
+    urls = get_series_supp_urls(gse)
+    if len(urls) == 0:
+        return res
+
+    directory = os.path.join(GEO_PATH, f"Supp_{gse_id}_series")
+    os.makedirs(directory, exist_ok=True)
+    for url in urls:
+        destination = os.path.join(directory, url.split("/")[-1])
+        if not os.path.isfile(destination):
+            logger.info(f"{gse_id} will download {url}")
+            download_from_url(url, destination, silent=True)
+    return _collect_supp_files(directory, peek=peek)
+
+
 def check_file_type(file_content: dict) -> FileType:
     file_type = FileType.UNKNOWN
     for f in file_content["files"]:
@@ -334,8 +528,8 @@ def check_file_type(file_content: dict) -> FileType:
             file_type = FileType.TABLE
         if "rdata" in f:
             file_type = FileType.RDATA
-        if ".h5." in f:
+        if ".h5." in f or f.endswith(".h5"):
             file_type = FileType.H5
-        if ".h5ad." in f:
+        if ".h5ad." in f or f.endswith(".h5ad"):
             file_type = FileType.H5AD
     return file_type
@@ -1,34 +1,767 @@
+import collections
+import functools
 import json
 import os
+import random
+import re
+import threading
+import time
 import typing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import modelscope_agent.llm
 from modelscope_agent.llm.base import BaseChatModel
 from modelscope_agent.utils.tokenization_utils import count_tokens
 
+from biagent import prompts
 from biagent.utils.logger import biagent_logger as logger
-from biagent.utils.output_parser import parse_json_markdown
+from biagent.utils.logger import biagent_transcripts
+from biagent.utils.output_parser import (
+    JsonStreamDetector,
+    parse_json_markdown,
+    parse_markdown,
+)
+
+# model servers whose client passes `response_format` through to the API
+JSON_MODE_MODEL_SERVERS = ("openai",)
+
+
+def supports_json_mode(llm: BaseChatModel) -> bool:
+    return getattr(llm, "model_server", None) in JSON_MODE_MODEL_SERVERS
+
+
+class ModelCascade:
+    """
+    Chat models from the cheapest to the most capable. JSON requests go to the first
+    model and are escalated to the next one when the response is invalid, rejected by
+    the caller, or self-reports a `confidence` below `confidence_threshold`. Free text
+    requests through `chat` go to the most capable model.
+    """
+
+    def __init__(self, tiers: list[BaseChatModel], confidence_threshold: float = 0.7):
+        if len(tiers) == 0:
+            raise ValueError("A model cascade needs at least one model")
+        self.tiers = tiers
+        self.confidence_threshold = confidence_threshold
+
+    @property
+    def model(self) -> str:
+        return ",".join(str(getattr(tier, "model", tier)) for tier in self.tiers)
+
+    @property
+    def model_server(self) -> str | None:
+        return getattr(self.tiers[-1], "model_server", None)
+
+    def chat(self, *args, **kwargs):
+        return self.tiers[-1].chat(*args, **kwargs)
+
+    def _escalation_reason(
+        self, response: dict, accept: typing.Callable | None
+    ) -> str | None:
+        confidence = response.get("confidence")
+        if isinstance(confidence, (int, float)) and (
+            confidence < self.confidence_threshold
+        ):
+            return f"low confidence ({confidence})"
+        if accept is not None and not accept(response):
+            return "response rejected"
+        return None
+
+    def get_valid_json_response(
+        self,
+        prompt: str,
+        max_retries: int = 3,
+        validator: typing.Callable | None = None,
+        accept: typing.Callable | None = None,
+    ) -> dict:
+        for i, tier in enumerate(self.tiers):
+            last = i == len(self.tiers) - 1
+            try:
+                response = get_valid_json_response(
+                    prompt, tier, max_retries=max_retries, validator=validator
+                )
+            except (json.JSONDecodeError, ValueError):
+                if last:
+                    raise
+                logger.info(f"Escalating from {tier.model}: invalid response")
+                continue
+            reason = None if last else self._escalation_reason(response, accept)
+            if reason is None:
+                return response
+            logger.info(f"Escalating from {tier.model}: {reason}")
+
+
+def _chat_stream_json(
+    prompt: str, llm: BaseChatModel, validator: typing.Callable | None, **kwargs
+) -> str:
+    """
+    Stream the response and stop it as soon as a complete JSON object that passes the
+    validator has arrived. Returns that object, or the full response if none did.
+    """
+    start = time.perf_counter()
+    detector = JsonStreamDetector()
+    chunks = llm.chat(prompt, stream=True, **kwargs)
+    first_token = None
+    try:
+        for chunk in chunks:
+            if first_token is None:
+                first_token = time.perf_counter()
+                logger.info(f"Time to first token: {first_token - start:.2f}s")
+            json_string = detector.feed(chunk)
+            while json_string is not None:
+                try:
+                    json_response = parse_json_markdown(json_string)
+                    if validator is None or validator(json_response):
+                        logger.info(
+                            f"Time to valid JSON: {time.perf_counter() - start:.2f}s"
+                        )
+                        return json_string
+                except (json.JSONDecodeError, ValueError):
+                    pass
+                detector.skip()
+                json_string = detector.feed("")
+    finally:
+        # closing the generator stops the generation
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return detector.text
 
 
 def get_valid_json_response(
-    prompt, llm, max_retries=3, validator: typing.Callable = None
+    prompt,
+    llm,
+    max_retries=3,
+    validator: typing.Callable = None,
+    json_mode: bool | None = None,
+    stream: bool | None = None,
+    accept: typing.Callable | None = None,
+    schema: str | None = None,
 ):
+    """
+    Chat with the LLM until its response parses as JSON and passes the validator.
+
+    Failed attempts are repaired rather than regenerated: the next prompt only carries
+    the expected schema, the broken response and the parser or validator error, which
+    is much shorter than the original prompt.
+
+    Args:
+        prompt: the prompt asking for a JSON response
+        llm: the chat model
+        max_retries: the maximum number of LLM calls, including repairs
+        validator: raises ValueError with the reason, or returns False, if the parsed
+            JSON is invalid. The reason is sent to the LLM to repair its response
+        json_mode: request JSON output from the backend, by default only for the
+            model servers known to support it
+        stream: stream the response and stop it once a valid JSON object has arrived,
+            by default enabled by `get_chat_model(..., stream_json=True)`
+        accept: for a `ModelCascade`, returns False if a valid response of a cheaper
+            model should be escalated to the next one
+        schema: the expected JSON format shown in the repair prompts, by default the
+            first json markdown blob of the prompt
+    """
+    if isinstance(llm, ModelCascade):
+        return llm.get_valid_json_response(
+            prompt, max_retries=max_retries, validator=validator, accept=accept
+        )
+    if json_mode is None:
+        json_mode = supports_json_mode(llm)
+    if stream is None:
+        stream = getattr(llm, "stream_json", False)
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    if schema is None and "```json" in prompt:
+        schema = parse_markdown(prompt, "json")
     retry = 0
+    request = prompt
     while True:
-        response = llm.chat(prompt)
+        if stream:
+            response = _chat_stream_json(request, llm, validator, **kwargs)
+        else:
+            response = llm.chat(request, **kwargs)
         try:
             json_response = parse_json_markdown(response)
-            if not validator(json_response):
-                raise ValueError("Invalid JSON response")
+            if validator is not None and not validator(json_response):
+                raise ValueError(
+                    "The JSON does not follow the required format, "
+                    "some fields are missing or have the wrong type"
+                )
             return json_response
         except (json.JSONDecodeError, ValueError) as e:  # noqa: E722
             logger.error(f"Invalid JSON response: {e}")
             retry += 1
             if retry >= max_retries:
                 raise
+            if response and response.strip():
+                request = prompts.json_repair.render(
+                    # drop the documentation links of the pydantic errors
+                    error=re.sub(r"\n\s*For further information visit \S+", "", str(e)),
+                    response=parse_markdown(response, "json"),
+                    schema=schema,
+                )
+            else:
+                # nothing to repair, ask again
+                request = prompt
             continue
 
 
+class TokenBucket:
+    """A bucket refilled at `rate_per_minute` up to `capacity`, thread-safe."""
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60
+        # bursts are limited to one second of quota by default
+        self.capacity = capacity if capacity is not None else max(1, self.rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, amount: float = 1):
+        """Block until `amount` is available and take it."""
+        # a request larger than the bucket waits for a full bucket and leaves the
+        # rest as debt, so the long-run rate still holds
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def consume(self, amount: float):
+        """Take `amount` without waiting, the bucket may go into debt."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class RateLimitError(RuntimeError):
+    pass
+
+
+class RateLimiter:
+    """
+    Request and token buckets for the RPM/TPM quotas of a model server, plus a limit on
+    the number of concurrent requests adjusted AIMD-style: it grows by one per window
+    of fast successful requests, shrinks by 10% when the latency rises above
+    `latency_tolerance` times the best latency seen, and halves on throttling.
+    """
+
+    def __init__(
+        self,
+        rpm: float | None = None,
+        tpm: float | None = None,
+        max_concurrency: int = 32,
+        min_concurrency: int = 1,
+        latency_tolerance: float = 2.0,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        expected_output_tokens: int = 512,
+    ):
+        self.requests = TokenBucket(rpm) if rpm is not None else None
+        self.tokens = TokenBucket(tpm) if tpm is not None else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max(min_concurrency, min(4, max_concurrency)))
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.expected_output_tokens = expected_output_tokens
+        self.in_flight = 0
+        self.best_latency = None
+        self.condition = threading.Condition()
+
+    def acquire(self, input_tokens: int):
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+        if self.requests is not None:
+            self.requests.acquire()
+        if self.tokens is not None:
+            self.tokens.acquire(input_tokens + self.expected_output_tokens)
+
+    def release(self, output_tokens: int | None = None):
+        if self.tokens is not None and output_tokens is not None:
+            # settle the estimate of the output tokens with the actual count
+            self.tokens.consume(output_tokens - self.expected_output_tokens)
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency: float):
+        with self.condition:
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if latency > self.latency_tolerance * self.best_latency:
+                self.concurrency = max(self.min_concurrency, self.concurrency * 0.9)
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+            self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        logger.warning(f"Throttled, concurrency lowered to {int(self.concurrency)}")
+
+    def call(self, func: typing.Callable, prompt: str, *args, **kwargs):
+        """Call the chat function within the quotas, retrying with backoff on 429s."""
+        input_tokens = count_tokens(prompt)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(input_tokens)
+            start = time.monotonic()
+            res, first = None, None
+            try:
+                res = func(prompt=prompt, *args, **kwargs)
+                if not isinstance(res, str):
+                    # streams send the request, or report its error, with the first chunk
+                    first = next(res, "")
+                    if _is_throttled(first):
+                        raise RateLimitError(first)
+                elif _is_throttled(res):
+                    raise RateLimitError(res)
+            except Exception as e:
+                if res is not None and hasattr(res, "close"):
+                    res.close()
+                self.release(0)
+                if not _is_throttle_error(e):
+                    raise
+                self.on_throttle()
+                if attempt == self.max_retries:
+                    raise RateLimitError(f"Rate limited after {attempt} retries: {e}")
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                continue
+            if isinstance(res, str):
+                self.release(count_tokens(res))
+                self.on_success(time.monotonic() - start)
+                return res
+            return self._release_stream(first, res, start)
+
+    def _release_stream(self, first: str, chunks: typing.Iterator[str], start: float):
+        # a streamed request holds its slot until the stream is consumed or closed
+        res = first
+        failed, throttled = False, False
+        try:
+            if first:
+                yield first
+            for chunk in chunks:
+                res += chunk
+                # dashscope reports an error in the middle of a stream as a chunk
+                throttled = throttled or _is_throttled(chunk)
+                yield chunk
+        except Exception as e:
+            failed, throttled = True, _is_throttle_error(e)
+            raise
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            self.release(count_tokens(res))
+            if throttled:
+                # too late to retry once chunks were yielded, only back off
+                self.on_throttle()
+            elif not failed:
+                self.on_success(time.monotonic() - start)
+
+
+_THROTTLE_PATTERN = re.compile(
+    r"\b429\b|rate.?limit|throttl|too many requests", re.IGNORECASE
+)
+
+
+def _is_throttled(message: str) -> bool:
+    # dashscope returns errors as the reply, e.g. "Error code: Throttling.RateQuota"
+    # streamed errors start with a newline
+    message = message.strip()
+    return message.startswith("Error code:") and bool(_THROTTLE_PATTERN.search(message))
+
+
+def _is_throttle_error(e: Exception) -> bool:
+    # the openai client raises `openai.RateLimitError` with the status code of the reply
+    return (
+        isinstance(e, RateLimitError)
+        or getattr(e, "status_code", None) == 429
+        or bool(_THROTTLE_PATTERN.search(str(e)))
+    )
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+
+
+def configure_rate_limiter(model_server: str, **kwargs) -> RateLimiter:
+    """
+    Set the quotas of a model server, shared by all the chat models created after by
+    `get_chat_model`. See `RateLimiter` for the options.
+    """
+    limiter = RateLimiter(**kwargs)
+    _rate_limiters[model_server] = limiter
+    return limiter
+
+
+def get_rate_limiter(model_server: str) -> RateLimiter | None:
+    return _rate_limiters.get(model_server)
+
+
+class _HedgeAttempt:
+    """
+    One of the duplicated requests of a hedged call. The responses opened by the
+    OpenAI compatible clients are registered, see `_track_usage`, so that a losing
+    request is closed at once instead of at its next chunk.
+    """
+
+    def __init__(self, timeout: float | None):
+        self.timeout = timeout
+        self.start = None
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+        self.responses = []
+        self.lock = threading.Lock()
+
+    def register(self, response) -> None:
+        with self.lock:
+            cancelled = self.cancelled.is_set()
+            if not cancelled:
+                self.responses.append(response)
+        if cancelled:
+            response.close()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled.set()
+            responses, self.responses = self.responses, []
+        for response in responses:
+            try:
+                # the thread reading it gets an error and is freed
+                response.close()
+            except Exception as e:
+                logger.debug(f"Error closing a hedged request: {e}")
+
+
+# the hedge attempt run by the current thread
+_hedge_attempt = threading.local()
+
+
+class HedgePolicy:
+    """
+    Duplicate a request that is slower than the `percentile` of the recent latencies,
+    the first successful response wins and the other request is cancelled by closing
+    its stream. At most a `budget` fraction of the requests are hedged. With OpenAI
+    compatible clients, each request times out after `timeout` seconds without data.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        budget: float = 0.05,
+        window: int = 200,
+        min_samples: int = 20,
+        min_delay: float = 1.0,
+        max_workers: int = 64,
+        timeout: float | None = 60.0,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.latencies = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self.calls = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def delay(self) -> float | None:
+        """The time to wait before hedging, None until enough latencies are known."""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def _take_budget(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def _consume(
+        self,
+        func: typing.Callable,
+        prompt: str,
+        args: tuple,
+        kwargs: dict,
+        attempt: _HedgeAttempt,
+    ) -> str:
+        attempt.start = time.monotonic()
+        attempt.started.set()
+        _hedge_attempt.value = attempt
+        try:
+            res = func(prompt, *args, stream=True, **kwargs)
+            if isinstance(res, str):
+                return res
+            text = ""
+            try:
+                for chunk in res:
+                    if attempt.cancelled.is_set():
+                        break
+                    text += chunk
+            finally:
+                res.close()
+            return text
+        finally:
+            _hedge_attempt.value = None
+
+    def _submit(self, func: typing.Callable, prompt: str, args: tuple, kwargs: dict):
+        attempt = _HedgeAttempt(self.timeout)
+        future = self.executor.submit(
+            self._consume, func, prompt, args, kwargs, attempt
+        )
+        return future, attempt
+
+    def call(self, func: typing.Callable, prompt: str, *args, **kwargs) -> str:
+        with self.lock:
+            self.calls += 1
+        delay = self.delay()
+        future, attempt = self._submit(func, prompt, args, kwargs)
+        requests = {future: attempt}
+        # the delay runs from the start of the request, not from its time in the queue
+        attempt.started.wait()
+        start = attempt.start
+        done, _ = wait(
+            requests,
+            timeout=(
+                None if delay is None else max(0.0, delay - (time.monotonic() - start))
+            ),
+        )
+        if not done and self._take_budget():
+            logger.info(f"Hedging a request slower than {delay:.1f}s")
+            future, attempt = self._submit(func, prompt, args, kwargs)
+            requests[future] = attempt
+
+        pending = set(requests)
+        error, fallback = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    res = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if res.strip().startswith("Error code:") and pending:
+                    # an error reply from the backend, wait for the other request
+                    fallback = res
+                    continue
+                for other in pending:
+                    requests[other].cancel()
+                with self.lock:
+                    self.latencies.append(time.monotonic() - start)
+                return res
+        if fallback is not None:
+            return fallback
+        raise error
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key wait for a single call and share its result.
+    Nothing is kept once the call has finished.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[typing.Hashable, SingleFlight._Call] = {}
+
+    def do(self, key: typing.Hashable, func: typing.Callable):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+_single_flight = SingleFlight()
+
+
+_hedge_policies: dict[str, HedgePolicy] = {}
+
+
+def configure_hedging(model_server: str, **kwargs) -> HedgePolicy:
+    """
+    Hedge the slow requests of a model server for all the chat models created after
+    by `get_chat_model`. See `HedgePolicy` for the options.
+    """
+    policy = HedgePolicy(**kwargs)
+    _hedge_policies[model_server] = policy
+    return policy
+
+
+class UsageTracker:
+    """
+    Token usage reported by the backend, summed over all calls, including the prompt
+    tokens served from the server-side prefix cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_calls = 0
+
+    def record(self, usage) -> None:
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.add(
+            getattr(usage, "prompt_tokens", 0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0,
+            getattr(details, "cached_tokens", 0) or 0,
+        )
+
+    def add(
+        self,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+        estimated: bool = False,
+    ) -> None:
+        """Add the usage of a call, `estimated` if it was counted locally."""
+        with self.lock:
+            self.calls += 1
+            self.estimated_calls += estimated
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+
+    def summary(self) -> str:
+        with self.lock:
+            rate = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0
+            estimated = (
+                f" ({self.estimated_calls} estimated)" if self.estimated_calls else ""
+            )
+            return (
+                f"{self.calls} calls{estimated}, {self.prompt_tokens} prompt tokens "
+                f"({self.cached_tokens} cached, {rate:.0%}), "
+                f"{self.completion_tokens} completion tokens"
+            )
+
+
+usage_tracker = UsageTracker()
+
+# opt in to request the usage of streams from servers other than these
+STREAM_USAGE = "BIAGENT_STREAM_USAGE"
+STREAM_USAGE_HOSTS = ("api.openai.com",)
+
+
+def _prompt_tokens(messages: list[dict]) -> int:
+    return sum(count_tokens(str(m.get("content") or "")) for m in messages)
+
+
+def _track_usage(model: BaseChatModel) -> None:
+    """
+    Record the usage of the responses of an OpenAI compatible client. Streams only
+    report their usage with `stream_options`, which is sent to the OpenAI API or when
+    `BIAGENT_STREAM_USAGE=on`, since other servers may reject it. The usage of the
+    other streams is estimated from the text.
+    """
+    client = getattr(model, "client", None)
+    completions = getattr(getattr(client, "chat", None), "completions", None)
+    if completions is None or getattr(completions.create, "tracked", False):
+        return
+    create = completions.create
+    host = getattr(getattr(client, "base_url", None), "host", None)
+    include_usage = (
+        host in STREAM_USAGE_HOSTS or os.getenv(STREAM_USAGE, "off").lower() == "on"
+    )
+
+    def tracked_stream(chunks, messages: list[dict]):
+        text = ""
+        reported = False
+        try:
+            for chunk in chunks:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    usage_tracker.record(usage)
+                    reported = True
+                # the usage arrives in a last chunk without choices, which the
+                # client of modelscope_agent cannot read
+                if chunk.choices:
+                    text += getattr(chunk.choices[0].delta, "content", None) or ""
+                    yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            if not reported:
+                usage_tracker.add(
+                    _prompt_tokens(messages), count_tokens(text), estimated=True
+                )
+
+    def tracked_create(*args, **kwargs):
+        nonlocal include_usage
+        if not kwargs.get("stream", False):
+            response = create(*args, **kwargs)
+            usage_tracker.record(getattr(response, "usage", None))
+            return response
+        messages = kwargs.get("messages", [])
+        # a hedged request times out and can be closed by the request that wins
+        attempt = getattr(_hedge_attempt, "value", None)
+        if attempt is not None and attempt.timeout is not None:
+            kwargs.setdefault("timeout", attempt.timeout)
+        chunks = None
+        if include_usage and "stream_options" not in kwargs:
+            try:
+                chunks = create(*args, stream_options={"include_usage": True}, **kwargs)
+            except Exception as e:
+                if getattr(e, "status_code", None) not in (400, 422):
+                    raise
+                logger.warning(
+                    f"`stream_options` rejected, estimating the usage of streams: {e}"
+                )
+                include_usage = False
+        if chunks is None:
+            chunks = create(*args, **kwargs)
+        if attempt is not None and hasattr(chunks, "close"):
+            attempt.register(chunks)
+        return tracked_stream(chunks, messages)
+
+    tracked_create.tracked = True
+    completions.create = tracked_create
+
+
 def get_llm_config(model: str) -> dict:
     if model.startswith("qwen"):
         return {"model": model, "model_server": "dashscope"}
@@ -42,31 +775,155 @@ def get_llm_config(model: str) -> dict:
         raise ValueError(f"Unsupported model: {model}")
 
 
-def get_chat_model(model: dict | BaseChatModel, verbose=True) -> BaseChatModel:
+def _unretried_chat(model: BaseChatModel) -> typing.Callable:
+    """
+    The chat of `model` without the retries of its client. Both `chat` of the model
+    and of `BaseChatModel` retry with a fixed delay and replace the error, so the
+    request is sent with `_chat_stream`/`_chat_no_stream` directly.
+    """
+    if not hasattr(model, "_chat_no_stream") or model.support_raw_prompt():
+        return model.chat
+
+    def chat(prompt=None, messages=None, stop=None, stream=False, **kwargs):
+        kwargs.pop("uuid_str", None)
+        kwargs.pop("append_files", None)
+        if isinstance(getattr(model, "support_stream", None), bool):
+            stream = model.support_stream
+        if not messages:
+            messages = [{"role": "user", "content": prompt}]
+        if stream:
+            return model._chat_stream(messages, stop=stop, **kwargs)
+        return model._chat_no_stream(messages, stop=stop, **kwargs)
+
+    return chat
+
+
+def get_chat_model(
+    model: str | dict | list | BaseChatModel | ModelCascade,
+    verbose=True,
+    stream_json: bool = False,
+) -> BaseChatModel | ModelCascade:
+    """
+    Args:
+        model: the model name, its config or the model itself. A list, or a comma
+            separated string of names, builds a `ModelCascade` from cheap to capable
+        verbose: write the prompts and responses to the transcripts
+        stream_json: stream the responses of `get_valid_json_response` and stop them
+            once a valid JSON object has arrived
+    """
+    if isinstance(model, str) and "," in model:
+        model = [m.strip() for m in model.split(",") if m.strip()]
+    if isinstance(model, list):
+        return ModelCascade([get_chat_model(m, verbose, stream_json) for m in model])
+    if isinstance(model, ModelCascade):
+        return model
     if isinstance(model, str):
         model = get_llm_config(model)
         model = modelscope_agent.llm.get_chat_model(**model)
     elif isinstance(model, dict):
         model = modelscope_agent.llm.get_chat_model(**model)
 
+    _track_usage(model)
+    limiter = get_rate_limiter(getattr(model, "model_server", None))
+    chat = model.chat
+    if getattr(chat, "rate_limited", False):
+        # already wrapped with the limiter
+        limiter = None
+    elif limiter is not None:
+        # throttling is handled by the limiter instead of the client's fixed retries
+        chat = _unretried_chat(model)
+
+    hedge = _hedge_policies.get(getattr(model, "model_server", None))
+    if getattr(chat, "hedged", False):
+        # already wrapped with the hedging policy
+        hedge = None
+    # identical requests are coalesced once, by the innermost wrapper
+    coalesce = not getattr(chat, "coalesced", False)
+
+    # the transcript is written once, by the innermost wrapper
+    transcribe = verbose and not getattr(chat, "transcribed", False)
+    model_name = getattr(model, "model", None)
+
+    def transcribe_call(prompt: str, res: str, start: float, **fields) -> None:
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"{model_name} replied in {elapsed:.2f}s, "
+            f"{len(prompt)} prompt and {len(res)} response characters"
+        )
+        # the tokens are counted by the transcript writer thread
+        biagent_transcripts.record(
+            model=model_name,
+            latency=round(elapsed, 3),
+            prompt=prompt,
+            response=res,
+            prompt_tokens=functools.partial(count_tokens, prompt),
+            response_tokens=functools.partial(count_tokens, res),
+            **fields,
+        )
+
+    def log_stream(
+        prompt: str, chunks: typing.Iterator[str], start: float
+    ) -> typing.Iterator[str]:
+        res = ""
+        try:
+            for chunk in chunks:
+                res += chunk
+                yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            transcribe_call(prompt, res, start, stream=True)
+
     def chat_wrapper(func: typing.Callable) -> typing.Callable:
+        def call(prompt: str, *args, **kwargs):
+            if limiter is not None:
+                return limiter.call(func, prompt, *args, **kwargs)
+            return func(prompt=prompt, *args, **kwargs)
+
         def wrapper(*args, **kwargs):
             if "prompt" in kwargs:
                 prompt = kwargs.pop("prompt")
             else:
                 prompt = args[0]
                 args = args[1:]
-            if verbose:
-                logger.info(
-                    f"Input tokens: {count_tokens(prompt)}\nSending prompt: {prompt}"
-                )
-            res = func(prompt=prompt, *args, **kwargs)
-            if verbose:
-                logger.info(f"Output tokens: {count_tokens(res)}\nResponse: {res}")
+            start = time.perf_counter()
+            if kwargs.get("stream", False):
+                res = call(prompt, *args, **kwargs)
+            else:
+                kwargs.pop("stream", None)
+
+                def request() -> str:
+                    if hedge is not None:
+                        return hedge.call(call, prompt, *args, **kwargs)
+                    return call(prompt, *args, **kwargs)
+
+                if coalesce:
+                    # identical requests in flight at the same time share one response
+                    key = (
+                        getattr(model, "model_server", None),
+                        getattr(model, "model", None),
+                        prompt,
+                        repr(args),
+                        json.dumps(kwargs, sort_keys=True, default=str),
+                    )
+                    res = _single_flight.do(key, request)
+                else:
+                    res = request()
+            if transcribe:
+                if not isinstance(res, str):
+                    return log_stream(prompt, res, start)
+                transcribe_call(prompt, res, start)
             return res
 
+        wrapper.rate_limited = limiter is not None or getattr(
+            func, "rate_limited", False
+        )
+        wrapper.hedged = hedge is not None or getattr(func, "hedged", False)
+        wrapper.coalesced = True
+        wrapper.transcribed = transcribe or getattr(func, "transcribed", False)
         return wrapper
 
-    model.chat = chat_wrapper(model.chat)
+    model.chat = chat_wrapper(chat)
+    model.stream_json = stream_json
 
     return model
@@ -1,9 +1,13 @@
 # code taken from: https://github.com/modelscope/modelscope-agent/blob/master/modelscope_agent/utils/logger.py
+import atexit
+import gzip
 import json
 import logging
 import os
+import queue
+import threading
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import Dict
 
 # environ params
@@ -14,18 +18,20 @@ LOG_ENABLE_FILE = "LOG_ENABLE_FILE"
 LOG_FILE_PATH = "LOG_FILE_PATH"
 LOG_MAX_BYTES = "LOG_MAX_BYTES"
 LOG_BACKUP_COUNT = "LOG_BACKUP_COUNT"
+LOG_ENABLE_TRANSCRIPT = "LOG_ENABLE_TRANSCRIPT"
 
 # constant
 LOG_NAME = "biagent"
 INFO_LOG_FILE_NAME = "info.log"
 ERROR_LOG_FILE_NAME = "error.log"
+TRANSCRIPT_FILE_NAME = "transcripts.jsonl.gz"
 
 
-def get_formatter(log_format_env):
+def get_formatter(log_format_env, color=False):
     if log_format_env == "json":
         formatter = JsonFormatter()
     else:
-        formatter = TextFormatter()
+        formatter = TextFormatter(color=color)
     return formatter
 
 
@@ -55,13 +61,28 @@ class JsonFormatter(logging.Formatter):
 
 class TextFormatter(logging.Formatter):
     """
-    Custom formatter to output logs in text format.
+    Custom formatter to output logs in text format, with the message coloured by level
+    if `color` is set.
     """
 
+    # ANSI color codes
+    RESET = "\033[0m"
+    COLORS = {
+        "INFO": "\033[32m",
+        "WARNING": "\033[33m",
+        "ERROR": "\033[31m",
+    }
+
+    def __init__(self, color=False):
+        super().__init__()
+        self.color = color
+
     def format(self, record):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
         level = record.levelname
         message = record.getMessage()
+        if self.color and level in self.COLORS:
+            message = f"{self.COLORS[level]}{message}{self.RESET}"
 
         # Collect additional fields if they are in the 'extra' dict
         uuid = getattr(record, "uuid", "-")
@@ -108,13 +129,10 @@ class AgentLogger:
     >>>         'info': 'complex log'
     >>>     }
     >>> )
-    """
 
-    # ANSI color codes
-    RESET = "\033[0m"
-    RED = "\033[31m"
-    GREEN = "\033[32m"
-    YELLOW = "\033[33m"
+    The records are put on a queue and written by the handlers in a background
+    thread, so the threads calling the LLM never wait on the console or the files.
+    """
 
     def __init__(self):
         self.logger = logging.getLogger(LOG_NAME)
@@ -123,14 +141,17 @@ class AgentLogger:
         self.logger.setLevel(getattr(logging, log_level))
 
         # Create console handler with TextFormatter
-        console_log_formatter = get_formatter(
-            os.getenv(LOG_CONSOLE_FORMAT, "normal").lower()
-        )
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(
-            get_formatter(log_format_env=console_log_formatter)
+            get_formatter(os.getenv(LOG_CONSOLE_FORMAT, "normal").lower(), color=True)
+        )
+        self.queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(self.queue))
+        self.listener = QueueListener(
+            self.queue, console_handler, respect_handler_level=True
         )
-        self.logger.addHandler(console_handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
 
         if os.environ.get(LOG_ENABLE_FILE, "on").lower() == "on":
             _log_dir = os.getenv(LOG_FILE_PATH, f"{os.getcwd()}/logs")
@@ -165,13 +186,13 @@ class AgentLogger:
         error_file_handler.setFormatter(file_log_formatter)
         error_file_handler.setLevel(logging.ERROR)
 
-        # Add handlers to the logger
-        self.logger.addHandler(info_file_handler)
-        self.logger.addHandler(error_file_handler)
+        # Add handlers to the listener
+        self.listener.stop()
+        self.listener.handlers += (info_file_handler, error_file_handler)
+        self.listener.start()
 
     def info(self, message: str, *args):
-        colored_message = f"{self.GREEN}{message}{self.RESET}"
-        self.logger.info(colored_message, *args)
+        self.logger.info(message, *args)
 
     def query_info(
         self,
@@ -196,8 +217,7 @@ class AgentLogger:
         )
 
     def error(self, message: str = "", *args):
-        colored_message = f"{self.RED}{message}{self.RESET}"
-        self.logger.error(colored_message, *args)
+        self.logger.error(message, *args)
 
     def query_error(
         self,
@@ -223,8 +243,7 @@ class AgentLogger:
         )
 
     def warning(self, message: str = "", *args):
-        colored_message = f"{self.YELLOW}{message}{self.RESET}"
-        self.logger.warning(colored_message, *args)
+        self.logger.warning(message, *args)
 
     def query_warning(
         self,
@@ -249,4 +268,108 @@ class AgentLogger:
         )
 
 
+class TranscriptStore:
+    """
+    The full prompts and responses of the LLM calls, kept apart from the logs as gzip
+    compressed JSON lines and rotated by size. The records are written by a background
+    thread, and callable values such as token counts are only evaluated there.
+
+    Examples:
+    ```python
+    >>> biagent_transcripts.record(
+    >>>     prompt=prompt,
+    >>>     response=response,
+    >>>     prompt_tokens=lambda: count_tokens(prompt),
+    >>> )
+    ```
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backup_count=7):
+        """
+        Args:
+            path (str): The transcript file, None to disable the transcripts.
+            max_bytes (int): Maximum compressed size of a transcript file, default 50MB.
+            backup_count (int): The number of transcript files to keep, default is 7.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = None
+        if path is not None:
+            self._thread = threading.Thread(
+                target=self._run, name="transcript-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def record(self, **fields):
+        if self.enabled:
+            fields.setdefault(
+                "timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            )
+            self.queue.put(fields)
+
+    def close(self):
+        """Write the records queued so far and stop the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            fields = self.queue.get()
+            if fields is None:
+                break
+            try:
+                fields = {k: v() if callable(v) else v for k, v in fields.items()}
+                self._write(json.dumps(fields, ensure_ascii=False, default=str) + "\n")
+            except Exception as e:
+                logging.getLogger(LOG_NAME).error(f"Failed to write transcript: {e}")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = gzip.open(self.path, "ab")
+        self._file.write(line.encode("utf-8"))
+        if os.fstat(self._file.fileobj.fileno()).st_size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+def get_transcript_store():
+    enabled = os.environ.get(
+        LOG_ENABLE_TRANSCRIPT, os.environ.get(LOG_ENABLE_FILE, "on")
+    )
+    if enabled.lower() != "on":
+        return TranscriptStore(None)
+    return TranscriptStore(
+        os.path.join(
+            os.getenv(LOG_FILE_PATH, f"{os.getcwd()}/logs"), TRANSCRIPT_FILE_NAME
+        ),
+        max_bytes=int(os.environ.get(LOG_MAX_BYTES, 50 * 1024 * 1024)),
+        backup_count=int(os.environ.get(LOG_BACKUP_COUNT, 7)),
+    )
+
+
 biagent_logger = AgentLogger()
+biagent_transcripts = get_transcript_store()
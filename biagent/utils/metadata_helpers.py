@@ -1,10 +1,13 @@
+import json
+
 import tqdm
 from GEOparse.GEOTypes import GSE, GSM
 from joblib import Memory, Parallel, delayed
+from scanpy import AnnData
 
 from biagent.tools import GeoMetadataExtraction
 from biagent.utils import geo_helpers
-from biagent.utils.llm_helpers import get_llm_config
+from biagent.utils.llm_helpers import usage_tracker
 from biagent.utils.logger import biagent_logger as logger
 
 
@@ -14,37 +17,27 @@ def metadata_task(
     gsm: GSM = None,
     gse: GSE = None,
     tool: GeoMetadataExtraction = None,
+    adata: AnnData = None,
 ) -> dict:
     assert gsm_id is not None or gsm is not None
     if gsm is None:
         gsm, gse = geo_helpers.get_geo(gsm_id, return_gse=True)
 
     if tool is None:
-        llm_config = get_llm_config(model)
-        tool = GeoMetadataExtraction(llm=llm_config)
-    extracted_metadata = tool.parse_gsm(gsm, gse)
+        tool = GeoMetadataExtraction(llm=model)
+    extracted_metadata = tool.parse_gsm(gsm, gse, adata=adata)
     return extracted_metadata
 
 
-def metadata_task_soft_file_list(
-    soft_file_list: str,
-    max_gsms_per_gse: int,
-    model: str,
-    parallel: int,
-    progress: bool = True,
-    cache_dir: str = None,
-) -> list[dict]:
+def load_soft_file_list(
+    soft_file_list: str, max_gsms_per_gse: int, parallel: int, progress: bool = True
+) -> list[tuple[GSM, GSE]]:
+    """Read the GSM and GSE objects of the soft files listed in a file."""
     with open(soft_file_list, "r") as f:
         soft_files = [l.strip() for l in f.readlines()]
 
     logger.info(f"Reading content from {len(soft_files)} soft files")
-    llm_config = {
-        "model": model,
-        "model_server": "dashscope",
-    }
-    tool = GeoMetadataExtraction(llm=llm_config)
-
-    gsms = [
+    return [
         t
         for tup in Parallel(n_jobs=parallel)(
             delayed(geo_helpers.process_soft_files)(
@@ -54,6 +47,18 @@ def metadata_task_soft_file_list(
         )
         for t in tup
     ]
+
+
+def metadata_task_soft_file_list(
+    soft_file_list: str,
+    max_gsms_per_gse: int,
+    model: str,
+    parallel: int,
+    progress: bool = True,
+    cache_dir: str = None,
+) -> list[dict]:
+    gsms = load_soft_file_list(soft_file_list, max_gsms_per_gse, parallel, progress)
+    tool = GeoMetadataExtraction(llm=model)
     if cache_dir is not None:
         logger.info(f"Caching GSM and GSE objects to {cache_dir}")
         _metadata_task_cached = Memory(location=cache_dir, verbose=0).cache(
@@ -72,4 +77,90 @@ def metadata_task_soft_file_list(
             delayed(_metadata_task_cached)(gsm=gsm, gse=gse, model=model, tool=tool)
             for gsm, gse in tqdm.tqdm(gsms, disable=not progress)
         )
+    logger.info(f"LLM usage: {usage_tracker.summary()}")
     return extracted_metadatas
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def _batch_custom_id(gsm_id: str, group_index: int) -> str:
+    return f"{gsm_id}:{group_index}"
+
+
+def emit_metadata_batch(
+    gsms: list[tuple[GSM, GSE]],
+    model: str,
+    output: str,
+    tool: GeoMetadataExtraction = None,
+    progress: bool = True,
+) -> int:
+    """
+    Write the metadata prompts of the samples as an OpenAI-style batch request file,
+    one chat completion per field group with the custom ID `{gsm}:{group_index}`.
+    Returns the number of requests written.
+    """
+    if "," in model:
+        # a batch job runs one model, the replies are not escalated
+        raise ValueError(f"Batch mode needs a single model, got the cascade {model}")
+    if tool is None:
+        # the prompts are rendered offline, no client is needed
+        tool = GeoMetadataExtraction(llm=None)
+    n_requests = 0
+    with open(output, "w", encoding="utf-8") as f:
+        for gsm, gse in tqdm.tqdm(gsms, disable=not progress):
+            _, llm_groups = tool.render_prompts(gsm, gse)
+            for group_index, _, prompt in llm_groups:
+                request = {
+                    "custom_id": _batch_custom_id(gsm.get_accession(), group_index),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": {
+                        "model": model,
+                        "messages": [{"role": "user", "content": prompt}],
+                    },
+                }
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                n_requests += 1
+    logger.info(f"Wrote {n_requests} batch requests to {output}")
+    return n_requests
+
+
+def read_batch_responses(path: str) -> dict[str, dict[int, str]]:
+    """
+    Read an OpenAI-style batch response file, returns the reply content by GSM and
+    group index. Failed requests are skipped.
+    """
+    replies = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            gsm_id, group_index = record["custom_id"].rsplit(":", 1)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code", 200) != 200:
+                logger.error(
+                    f"Batch request {record['custom_id']} failed: "
+                    f"{record.get('error') or response.get('body')}"
+                )
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            replies.setdefault(gsm_id, {})[int(group_index)] = content
+    return replies
+
+
+def ingest_metadata_batch(
+    gsms: list[tuple[GSM, GSE]],
+    responses: str,
+    tool: GeoMetadataExtraction = None,
+    progress: bool = True,
+) -> list[dict]:
+    """Assemble the metadata of the samples from the responses of a batch job."""
+    if tool is None:
+        tool = GeoMetadataExtraction(llm=None)
+    replies = read_batch_responses(responses)
+    return [
+        tool.parse_gsm(gsm, gse, replies=replies.get(gsm.get_accession(), {}))
+        for gsm, gse in tqdm.tqdm(gsms, disable=not progress)
+    ]
@@ -14,36 +14,6 @@ def json_indent_limit(json_string, indent="  ", limit=3):
     return regexPattern.sub("", json_string)
 
 
-def _replace_new_line(match: re.Match[str]) -> str:
-    value = match.group(2)
-    value = re.sub(r"\n", r"\\n", value)
-    value = re.sub(r"\r", r"\\r", value)
-    value = re.sub(r"\t", r"\\t", value)
-    value = re.sub(r'(?<!\\)"', r"\"", value)
-
-    return match.group(1) + value + match.group(3)
-
-
-def _custom_parser(multiline_string: str) -> str:
-    """
-    The LLM response for `action_input` may be a multiline
-    string containing unescaped newlines, tabs or quotes. This function
-    replaces those characters with their escaped counterparts.
-    (newlines in JSON must be double-escaped: `\\n`)
-    """
-    if isinstance(multiline_string, (bytes, bytearray)):
-        multiline_string = multiline_string.decode()
-
-    multiline_string = re.sub(
-        r'("action_input"\:\s*")(.*)(")',
-        _replace_new_line,
-        multiline_string,
-        flags=re.DOTALL,
-    )
-
-    return multiline_string
-
-
 def parse_markdown(code_string: str, mtype: MarkdownTypes) -> Union[str, dict]:
     """
     Parse markdown string
@@ -75,18 +45,106 @@ def parse_sql_markdown(code_string: str) -> str:
     return parse_markdown(code_string, "sql")
 
 
+_JSON_FENCE = re.compile(r"```json", re.IGNORECASE)
+# a string is closed by a quote followed by one of these, other quotes are unescaped
+# quotes inside the string
+_STRING_END = r"\s*(?:[,:}\]]|//|/\*|$)"
+# a run of valid JSON outside strings, copied as is: anything but strings, comments
+# and Python literals, and the strings without control characters. The loops are
+# unrolled so that long runs are matched, and malformed strings rejected at their
+# first quote or control character, without backtracking
+_PLAIN = re.compile(
+    r'[^"/TFN]*(?:(?:(?!(?:True|False|None)\b)[TFN]'
+    r'|"[^"\\\n\r\t]*(?:\\.[^"\\\n\r\t]*)*"(?=' + _STRING_END + r'))[^"/TFN]*)*',
+    re.DOTALL,
+)
+_COMMENT_OR_LITERAL = re.compile(
+    r"//[^\n]*|/\*.*?(?:\*/|$)|(?<!\w)(?:True|False|None)\b", re.DOTALL
+)
+# inside strings: the characters that end, escape or break a string
+_INSIDE_STRING = re.compile(r'[\\"\n\r\t]')
+_STRING_END_AT = re.compile(_STRING_END)
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_json_decoder = json.JSONDecoder()
+
+
+def _fix_json(text: str) -> str:
+    """
+    Scan the text once, tracking whether it is inside a string: comments and Python
+    literals are fixed outside strings, raw control characters and unescaped quotes
+    are escaped inside them. A string left open, as in a truncated reply, is copied
+    up to the end.
+    """
+    out = []
+    pos, n = 0, len(text)
+    while pos < n:
+        plain = _PLAIN.match(text, pos)
+        out.append(plain.group())
+        pos = plain.end()
+        if pos >= n:
+            break
+        if text[pos] != '"':
+            token = _COMMENT_OR_LITERAL.match(text, pos)
+            if token is None:
+                # a lone slash
+                out.append(text[pos])
+                pos += 1
+            else:
+                out.append(_PYTHON_LITERALS.get(token.group(), ""))
+                pos = token.end()
+            continue
+
+        # a string with control characters or unescaped quotes
+        out.append('"')
+        pos += 1
+        while pos < n:
+            match = _INSIDE_STRING.search(text, pos)
+            if match is None:
+                out.append(text[pos:])
+                pos = n
+                break
+            i = match.start()
+            out.append(text[pos:i])
+            char = text[i]
+            pos = i + 1
+            if char == "\\":
+                out.append(text[i : i + 2])
+                pos = i + 2
+            elif char != '"':
+                out.append(_CONTROL_ESCAPES[char])
+            elif _STRING_END_AT.match(text, pos):
+                out.append(char)
+                break
+            else:
+                out.append('\\"')
+    return "".join(out)
+
+
+def extract_json(code_string: str) -> str:
+    """
+    Locate the JSON value in an LLM response, the content of a ```json block or the
+    first bare object or array, and make it valid JSON in one linear scan: comments
+    and Python literals outside strings are fixed, raw newlines and quotes inside
+    strings are escaped, and well-formed JSON is copied as is.
+    """
+    fence = _JSON_FENCE.search(code_string)
+    pos = fence.end() if fence is not None else 0
+    starts = [i for i in (code_string.find(c, pos) for c in "{[") if i >= 0]
+    if not starts:
+        return code_string[pos:].strip().strip("`").strip()
+    end = code_string.rfind("```")
+    if end <= pos:
+        end = len(code_string)
+    return _fix_json(code_string[min(starts) : end]).strip()
+
+
 def parse_json_markdown(code_string: str) -> dict:
-    json_str = parse_markdown(code_string, "json")
-    # handle errors
-    json_str = json_str.replace("True", "true").replace("False", "false")
-    # Remove comments (anything after // in a line)
-    lines = json_str.split("\n")
-    cleaned_lines = [line.split("//")[0].rstrip() for line in lines]
-    json_str = "\n".join(cleaned_lines)
-    json_str = _custom_parser(json_str)
+    json_str = extract_json(code_string)
 
     try:
-        return json.loads(json_str)
+        # the text after the JSON value is ignored
+        return _json_decoder.raw_decode(json_str)[0]
     except json.JSONDecodeError as e:
         logger.error(
             f"Error parsing json: {e}. Please check the json string: {json_str}"
@@ -94,6 +152,74 @@ def parse_json_markdown(code_string: str) -> dict:
         raise
 
 
+class JsonStreamDetector:
+    """
+    Incrementally find the first complete JSON object in a streamed LLM response.
+    Each character is scanned once; quotes, escapes and `//` comments are tracked so
+    braces inside strings or comments are not counted.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._in_comment = False
+        self._found = None
+
+    def feed(self, chunk: str) -> str | None:
+        """Add a chunk, returns the first complete object once it has been received."""
+        self.text += chunk
+        if self._found is not None:
+            return self._found
+        text = self.text
+        while self._pos < len(text):
+            c = text[self._pos]
+            if self._start is None:
+                if c == "{":
+                    self._start = self._pos
+                    self._depth = 1
+            elif self._in_comment:
+                if c == "\n":
+                    self._in_comment = False
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "/":
+                if self._pos + 1 == len(text):
+                    # wait for the next chunk to tell whether a comment starts
+                    return None
+                self._in_comment = text[self._pos + 1] == "/"
+            elif c == "{":
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos += 1
+                    self._found = text[self._start : self._pos]
+                    return self._found
+            self._pos += 1
+        return None
+
+    def skip(self):
+        """Discard the object found and look for the next one after its opening brace."""
+        self._pos = self._start + 1
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._in_comment = False
+        self._found = None
+
+
 def parse_json(code_string: str, parser=json.loads):
     try:
         res = parser(code_string)
@@ -107,52 +233,63 @@ def parse_json(code_string: str, parser=json.loads):
         return None
 
 
+def _nested_columns(df: pd.DataFrame, columns) -> tuple[list, list]:
+    """
+    The columns holding only lists and only dicts. The type of the first value is
+    used as a sample, only the object columns where it is a list or a dict are checked
+    on all rows.
+    """
+    list_columns, dict_columns = [], []
+    for col in columns:
+        values = df[col]
+        if values.dtype != object or values.empty:
+            continue
+        sample = type(values.iat[0])
+        if sample not in (list, dict):
+            continue
+        if all(type(value) is sample for value in values):
+            (list_columns if sample is list else dict_columns).append(col)
+    return list_columns, dict_columns
+
+
 def flatten_nested_json_df(df: pd.DataFrame):
+    """
+    Flatten the dict columns into one column per key, and explode the list columns
+    into one row per item, until no nested column is left.
+    """
     if df.empty:
         return df
 
     df = df.reset_index()
+    logger.info(f"Flattening dataframe of shape {df.shape}")
 
-    print(f"original shape: {df.shape}")
-    print(f"original columns: {df.columns}")
-
-    # search for columns to explode/flatten
-    s = (df.applymap(type) == list).all()
-    list_columns = s[s].index.tolist()
-
-    s = (df.applymap(type) == dict).all()
-    dict_columns = s[s].index.tolist()
-
-    print(f"lists: {list_columns}, dicts: {dict_columns}")
-    while len(list_columns) > 0 or len(dict_columns) > 0:
+    list_columns, dict_columns = _nested_columns(df, df.columns)
+    while list_columns or dict_columns:
+        logger.info(
+            f"Exploding lists: {list_columns}, flattening dicts: {dict_columns}"
+        )
         new_columns = []
 
-        for col in dict_columns:
-            print(f"flattening: {col}")
-            # explode dictionaries horizontally, adding new columns
-            horiz_exploded = pd.json_normalize(df[col]).add_prefix(f"{col}.")
-            horiz_exploded.index = df.index
-            df = pd.concat([df, horiz_exploded], axis=1).drop(columns=[col])
-            new_columns.extend(horiz_exploded.columns)  # inplace
+        if dict_columns:
+            # json_normalize flattens the nested dicts of all levels at once
+            flattened = []
+            for col in dict_columns:
+                horiz_exploded = pd.json_normalize(df[col].tolist()).add_prefix(
+                    f"{col}."
+                )
+                horiz_exploded.index = df.index
+                flattened.append(horiz_exploded)
+                new_columns.extend(horiz_exploded.columns)
+            df = pd.concat([df.drop(columns=dict_columns), *flattened], axis=1)
 
         for col in list_columns:
-            print(f"exploding: {col}")
-            # explode lists vertically, adding new columns
-            df = df.drop(columns=[col]).join(df[col].explode().to_frame())
-            # Prevent combinatorial explosion when multiple
-            # cols have lists or lists of lists
-            df = df.reset_index(drop=True)
+            # exploding the columns one after the other gives every combination of
+            # their items, with a fresh index to prevent duplicated labels
+            df = df.explode(col, ignore_index=True)
             new_columns.append(col)
 
-        # check if there are still dict o list fields to flatten
-        s = (df[new_columns].applymap(type) == list).all()
-        list_columns = s[s].index.tolist()
-
-        s = (df[new_columns].applymap(type) == dict).all()
-        dict_columns = s[s].index.tolist()
-
-        print(f"lists: {list_columns}, dicts: {dict_columns}")
+        # only the new columns can still hold dicts or lists
+        list_columns, dict_columns = _nested_columns(df, new_columns)
 
-    print(f"final shape: {df.shape}")
-    print(f"final columns: {df.columns}")
+    logger.info(f"Flattened dataframe to shape {df.shape}")
     return df
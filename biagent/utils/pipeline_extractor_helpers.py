@@ -0,0 +1,117 @@
+import glob
+import hashlib
+import json
+import os
+
+import tqdm
+from joblib import Parallel, delayed
+
+from biagent.tools import PipelineExtractor
+from biagent.utils.llm_helpers import usage_tracker
+from biagent.utils.logger import biagent_logger as logger
+
+CONSOLIDATED_FILE_NAME = "pipelines.jsonl"
+
+
+def _list_papers(papers: str) -> list[str]:
+    """A directory of markdown papers, or a file with one paper path per line."""
+    if os.path.isdir(papers):
+        return sorted(glob.glob(os.path.join(papers, "**", "*.md"), recursive=True))
+    with open(papers, "r") as f:
+        return [l.strip() for l in f.readlines() if l.strip()]
+
+
+def _result_path(paper: str, output_dir: str) -> str:
+    # papers with the same file name in different folders get their own result
+    stem = os.path.splitext(os.path.basename(paper))[0]
+    digest = hashlib.sha1(os.path.abspath(paper).encode()).hexdigest()[:10]
+    return os.path.join(output_dir, f"{stem}-{digest}.json")
+
+
+def _write_json(obj, path: str) -> None:
+    # write to a temporary file first so an interrupted job never leaves a partial result
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def pipeline_task(paper: str, tool: PipelineExtractor, output_dir: str) -> dict | None:
+    """
+    Extract the pipeline of one paper, skipping it if its result already exists.
+    Returns None if the extraction failed, so that the paper is retried on the next run.
+    """
+    result_path = _result_path(paper, output_dir)
+    if os.path.isfile(result_path):
+        with open(result_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        if os.path.abspath(result.get("paper", "")) == os.path.abspath(paper):
+            return result
+        logger.warning(f"{result_path} belongs to another paper, extracting {paper}")
+    try:
+        tools = tool.extract_pipeline(paper)
+    except KeyboardInterrupt as exce:
+        raise KeyboardInterrupt from exce
+    except Exception as e:
+        logger.error(f"Error extracting pipeline from {paper}: {e}")
+        return None
+    result = {"paper": paper, "tools": tools}
+    _write_json(result, result_path)
+    return result
+
+
+def pipeline_task_paper_list(
+    papers: str,
+    model: str,
+    parallel: int,
+    output_dir: str,
+    progress: bool = True,
+    cache_dir: str = ".cache",
+    retrieval_top_k: int | None = None,
+    window_tokens: int | None = None,
+    methods_only: bool = True,
+    strategy: str = "per_node",
+    stream: bool = False,
+) -> list[dict]:
+    """
+    Extract the pipelines of many papers with a shared LLM client and response cache.
+
+    One JSON result is written per paper and all results are consolidated into
+    `pipelines.jsonl` in `output_dir`. Papers with an existing result are skipped, so
+    an interrupted job can be resumed by running it again.
+    """
+    paper_paths = _list_papers(papers)
+    os.makedirs(output_dir, exist_ok=True)
+    logger.info(f"Extracting pipelines from {len(paper_paths)} papers")
+    tool = PipelineExtractor(
+        llm=model,
+        cache=True,
+        cache_dir=cache_dir,
+        retrieval_top_k=retrieval_top_k,
+        window_tokens=window_tokens,
+        methods_only=methods_only,
+        strategy=strategy,
+        stream=stream,
+    )
+
+    if parallel == 1:
+        results = [
+            pipeline_task(paper, tool, output_dir)
+            for paper in tqdm.tqdm(paper_paths, disable=not progress)
+        ]
+    else:
+        results = Parallel(n_jobs=parallel, backend="threading")(
+            delayed(pipeline_task)(paper, tool, output_dir)
+            for paper in tqdm.tqdm(paper_paths, disable=not progress)
+        )
+    results = [r for r in results if r is not None]
+
+    consolidated_path = os.path.join(output_dir, CONSOLIDATED_FILE_NAME)
+    with open(consolidated_path, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    logger.info(
+        f"Extracted {len(results)}/{len(paper_paths)} pipelines to {consolidated_path}"
+    )
+    logger.info(f"LLM usage: {usage_tracker.summary()}")
+    return results
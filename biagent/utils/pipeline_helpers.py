@@ -1,8 +1,16 @@
+import functools
 import json
+import math
+import os
+import re
+from collections import Counter
+from importlib import resources
 from typing import Generator
 
 import matplotlib.pyplot as plt
 import networkx as nx
+from modelscope_agent.utils.tokenization_utils import count_tokens
+from nltk.stem import PorterStemmer
 from nltk.tokenize import BlanklineTokenizer, word_tokenize
 from pydantic import BaseModel
 from typing_extensions import Literal
@@ -31,6 +39,75 @@ class PipelineNode(BaseModel):
     metadata: dict
 
 
+_HEADING_PATTERN = re.compile(
+    r"^(?:(?P<hashes>#{1,6})\s+(?P<atx>.+?)\s*#*|\*\*(?P<bold>[^*]{1,100})\*\*:?)\s*$"
+)
+_SECTION_NUMBER_PATTERN = re.compile(r"^((?:\d+\.)*\d+|[IVX]+)\.?\s+")
+_METHODS_PATTERN = re.compile(
+    r"\b(methods?|materials?|experimental (procedures?|design|model)|"
+    r"data (processing|analysis|analyses)|bioinformatics?|computational|"
+    r"statistical analys[ie]s)\b",
+    re.IGNORECASE,
+)
+_OTHER_SECTION_PATTERN = re.compile(
+    r"^(abstract|summary|introduction|background|results?|results and discussion|"
+    r"discussion|conclusions?|references|bibliography|acknowledge?ments?|"
+    r"author contributions?|competing interests?|declaration of interests?|"
+    r"conflicts? of interest|funding|figure legends?|figures?|tables?|"
+    r"supplementary (information|figures?|tables?)|data availability|"
+    r"code availability)\b",
+    re.IGNORECASE,
+)
+
+
+def _parse_heading(line: str) -> tuple[int, str] | None:
+    """The level and title of a markdown heading line, None if it is not one."""
+    match = _HEADING_PATTERN.match(line.strip())
+    if match is None:
+        return None
+    if match.group("hashes"):
+        level, title = len(match.group("hashes")), match.group("atx")
+    else:
+        # bold lines are used as headings by some PDF converters
+        level, title = 7, match.group("bold")
+    number = _SECTION_NUMBER_PATTERN.match(title)
+    if number is not None:
+        # numbered sub-sections are nested under their parent, e.g. 2.1 under 2
+        level += number.group(1).count(".")
+        title = title[number.end() :]
+    return level, title.strip()
+
+
+def extract_methods_section(paper_content: str) -> str:
+    """
+    Keep only the methods and data processing sections of a paper in markdown.
+
+    A methods section starts at a heading such as "Materials and methods" and ends at
+    the next heading of the same or a higher level that names another part of the
+    paper, e.g. "Results" or "References". Unrecognised headings inside a methods
+    section are kept, as PDF converters often flatten the heading levels. The whole
+    paper is returned if no methods section is found.
+    """
+    lines = paper_content.splitlines()
+    kept = []
+    methods_level = None
+    for line in lines:
+        heading = _parse_heading(line)
+        if heading is not None:
+            level, title = heading
+            if methods_level is not None and level <= methods_level:
+                if _OTHER_SECTION_PATTERN.match(title):
+                    methods_level = None
+            if methods_level is None and _METHODS_PATTERN.search(title):
+                if not _OTHER_SECTION_PATTERN.match(title):
+                    methods_level = level
+        if methods_level is not None:
+            kept.append(line)
+    if len(kept) == 0:
+        return paper_content
+    return "\n".join(kept)
+
+
 class ParagraphRotator:
     def __init__(self, paper_content: str, min_word_limit: int = None):
         paragraphs = [p.strip() for p in BlanklineTokenizer().tokenize(paper_content)]
@@ -38,17 +115,17 @@ class ParagraphRotator:
             self.paragraphs = paragraphs
         else:
             self.paragraphs = []
-            cur_p = ""
+            cur_p, cur_words = [], 0
             for i, p in enumerate(paragraphs):
-                cur_p += "\n\n" + p if len(cur_p) > 0 else p
-                if (
-                    len(word_tokenize(cur_p)) > min_word_limit
-                    or i == len(paragraphs) - 1
-                ):
-                    self.paragraphs.append(cur_p)
-                    cur_p = ""
+                # count the words of each paragraph once instead of the merged text
+                cur_p.append(p)
+                cur_words += len(word_tokenize(p))
+                if cur_words > min_word_limit or i == len(paragraphs) - 1:
+                    self.paragraphs.append("\n\n".join(cur_p))
+                    cur_p, cur_words = [], 0
 
         self.index = 0
+        self._token_counts: dict[int, int] = {}
 
     def get(self):
         return self.paragraphs[self.index]
@@ -69,28 +146,207 @@ class ParagraphRotator:
     def has_next(self):
         return self.index < len(self.paragraphs)
 
+    def window(self, token_budget: int) -> list[str]:
+        """
+        The paragraphs from the current one on that fit in `token_budget` tokens.
+        The current paragraph is always included, even if it exceeds the budget.
+        """
+        window, tokens = [], 0
+        for i in range(self.index, len(self.paragraphs)):
+            if i not in self._token_counts:
+                self._token_counts[i] = count_tokens(self.paragraphs[i])
+            tokens += self._token_counts[i]
+            if window and tokens > token_budget:
+                break
+            window.append(self.paragraphs[i])
+        return window
+
+    def fork(self, index: int | None = None) -> "ParagraphRotator":
+        """A new cursor over the same paragraphs."""
+        rotator = ParagraphRotator.from_paragraphs(self.paragraphs)
+        rotator.index = self.index if index is None else index
+        # token counts are shared between forks
+        rotator._token_counts = self._token_counts
+        return rotator
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs: list[str]) -> "ParagraphRotator":
+        rotator = cls.__new__(cls)
+        rotator.paragraphs = list(paragraphs)
+        rotator.index = 0
+        rotator._token_counts = {}
+        return rotator
+
+
+_STOP_WORDS = frozenset(
+    "a an and are as at be by for from in into is it of on or that the to was were "
+    "with we using used".split()
+)
+
+
+_stemmer = PorterStemmer()
+
+
+@functools.lru_cache(maxsize=65536)
+def _stem(token: str) -> str:
+    return _stemmer.stem(token)
+
+
+def _bm25_tokenize(text: str) -> list[str]:
+    return [
+        _stem(t) for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in _STOP_WORDS
+    ]
+
+
+class ParagraphIndex:
+    """
+    BM25 index over the paragraphs of a paper, built once per paper and used to rank
+    the paragraphs by relevance to a pipeline task.
+    """
+
+    def __init__(self, paragraphs: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(_bm25_tokenize(p)) for p in paragraphs]
+        self.doc_lens = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_doc_len = sum(self.doc_lens) / max(len(self.doc_lens), 1)
+        doc_freqs = Counter(t for tf in self.term_freqs for t in tf)
+        n_docs = len(paragraphs)
+        self.idf = {
+            t: math.log((n_docs - n + 0.5) / (n + 0.5) + 1)
+            for t, n in doc_freqs.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        query_terms = [t for t in _bm25_tokenize(query) if t in self.idf]
+        scores = []
+        for tf, doc_len in zip(self.term_freqs, self.doc_lens):
+            norm = self.k1 * (1 - self.b + self.b * doc_len / (self.avg_doc_len or 1))
+            scores.append(
+                sum(
+                    self.idf[t] * tf[t] * (self.k1 + 1) / (tf[t] + norm)
+                    for t in query_terms
+                    if t in tf
+                )
+            )
+        return scores
+
+    def top_k(self, query: str, k: int) -> list[int]:
+        """Indices of the `k` most relevant paragraphs with a positive score."""
+        scores = self.scores(query)
+        ranked = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+        return [i for i in ranked[:k] if scores[i] > 0]
+
+
+DEFAULT_PIPELINE_DEFINITION = "sc_rna_seq_pipeline.json"
+
+
+class CompiledPipeline:
+    """
+    A validated pipeline definition with precomputed BFS order, topological layers,
+    adjacency and labels, shared by all `Pipeline` instances of the same definition.
+    """
+
+    def __init__(self, nodes: list[PipelineNode]):
+        self.nodes: dict[int, PipelineNode] = {}
+        for node in nodes:
+            if node.id in self.nodes:
+                raise ValueError(f"Duplicate pipeline node id: {node.id}")
+            self.nodes[node.id] = node
+        for node in nodes:
+            for dep in node.dep:
+                if dep not in self.nodes:
+                    raise ValueError(f"Node {node.id} depends on unknown node {dep}")
+
+        self.labels = {node.id: node.name for node in nodes}
+        self.predecessors = {node.id: tuple(node.dep) for node in nodes}
+        successors = {node.id: [] for node in nodes}
+        for node in nodes:
+            for dep in node.dep:
+                successors[dep].append(node.id)
+        self.successors = {k: tuple(v) for k, v in successors.items()}
+        self.predecessor_labels = {
+            k: tuple(self.labels[p] for p in v) for k, v in self.predecessors.items()
+        }
+        self.successor_labels = {
+            k: tuple(self.labels[s] for s in v) for k, v in self.successors.items()
+        }
+
+        G = self.graph()
+        if not nx.is_directed_acyclic_graph(G):
+            raise ValueError("The pipeline definition contains a cycle")
+        self.layers = tuple(
+            tuple(sorted(layer)) for layer in nx.topological_generations(G)
+        )
+        # BFS from each root, the order tool extraction follows
+        bfs_order = {}
+        for root in (node.id for node in nodes if len(node.dep) == 0):
+            bfs_order.update(dict.fromkeys(nx.bfs_tree(G, root)))
+        self.bfs_order = tuple(bfs_order)
+
+    def graph(self) -> nx.DiGraph:
+        """A new graph of the pipeline, without any extracted tools."""
+        G = nx.DiGraph()
+
+        # Add nodes with labels
+        for node in self.nodes.values():
+            G.add_node(
+                node.id,
+                label=node.name,
+                name=node.name,
+                tool=None,
+                tool_info=None,
+                metadata=node.model_dump(),
+                has_tool_info=False,
+            )
+
+        # Add edges based on dependencies
+        for node in self.nodes.values():
+            for dep in node.dep:
+                G.add_edge(dep, node.id)
+
+        return G
+
+
+@functools.lru_cache(maxsize=None)
+def _load_pipeline_definition(path: str) -> CompiledPipeline:
+    with open(path, "r") as file:
+        data = json.load(file)
+    return CompiledPipeline([PipelineNode.model_validate(node) for node in data])
+
+
+def load_pipeline_definition(
+    pipeline_definition: str | None = None,
+) -> CompiledPipeline:
+    """
+    Load and compile a pipeline definition, each file is only read once per process.
+    The packaged scRNA-seq pipeline is used if no path is given.
+    """
+    if pipeline_definition is None:
+        path = resources.files("biagent") / "data" / DEFAULT_PIPELINE_DEFINITION
+        pipeline_definition = str(path)
+    return _load_pipeline_definition(os.path.abspath(pipeline_definition))
+
 
 class Pipeline:
-    def __init__(
-        self, pipeline_definition: str = "data/sc_rna_seq_pipeline.json"
-    ) -> None:
-        self.G = self._create_graph_from_json(pipeline_definition)
+    def __init__(self, pipeline_definition: str | None = None) -> None:
+        self.definition = load_pipeline_definition(pipeline_definition)
+        self.G = self.definition.graph()
 
     def iter_nodes(self) -> Generator[PipelineNode, None, None]:
-        for node in nx.bfs_tree(self.G, 1).nodes:
-            yield PipelineNode.model_validate(
-                nx.get_node_attributes(self.G, "metadata")[node]
-            )
+        for node in self.definition.bfs_order:
+            yield self.definition.nodes[node]
+
+    def iter_layers(self) -> Generator[list[PipelineNode], None, None]:
+        """Yield the nodes of each topological generation, independent of each other."""
+        for layer in self.definition.layers:
+            yield [self.definition.nodes[node] for node in layer]
 
     def predecessor_labels(self, id):
-        return [
-            nx.get_node_attributes(self.G, "label")[p] for p in self.G.predecessors(id)
-        ]
+        return list(self.definition.predecessor_labels[id])
 
     def successor_labels(self, id):
-        return [
-            nx.get_node_attributes(self.G, "label")[p] for p in self.G.successors(id)
-        ]
+        return list(self.definition.successor_labels[id])
 
     def set_node(self, node: PipelineNode, tool: ToolMetadata) -> None:
         nx.set_node_attributes(
@@ -100,13 +356,29 @@ class Pipeline:
                     "tool": json_indent_limit(tool.model_dump_json(indent=2)).replace(
                         "\n", "<br>"
                     ),
+                    "tool_info": tool.model_dump(),
                     "has_tool_info": True,
                 }
             },
         )
 
+    def to_json(self) -> list[dict]:
+        """The pipeline nodes with their extracted tools, `tool` is None if missing."""
+        return [
+            {
+                **node.model_dump(exclude={"metadata"}),
+                "tool": self.G.nodes[node.id]["tool_info"],
+            }
+            for node in self.definition.nodes.values()
+        ]
+
     def save(self, filename, save_as="html"):
-        for layer, nodes in enumerate(nx.topological_generations(self.G)):
+        if save_as == "json":
+            with open(filename, "w", encoding="utf-8") as f:
+                json.dump(self.to_json(), f, ensure_ascii=False, indent=2)
+            return
+
+        for layer, nodes in enumerate(self.definition.layers):
             # `multipartite_layout` expects the layer as a node attribute, so add the
             # numeric layer value as a node attribute
             for node in nodes:
@@ -146,29 +418,3 @@ class Pipeline:
                 node_label="name",
             )
             plotly_g.write_html(filename)
-        elif save_as == "json":
-            raise NotImplementedError
-
-    def _create_graph_from_json(self, json_file):
-        with open(json_file, "r") as file:
-            data = json.load(file)
-
-        G = nx.DiGraph()
-
-        # Add nodes with labels
-        for node in data:
-            G.add_node(
-                node["id"],
-                label=node["name"],
-                name=node["name"],
-                tool=None,
-                metadata=node,
-                has_tool_info=False,
-            )
-
-        # Add edges based on dependencies
-        for node in data:
-            for dep in node["dep"]:
-                G.add_edge(dep, node["id"])
-
-        return G
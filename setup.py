@@ -43,6 +43,7 @@ if __name__ == "__main__":
         author="biagent Contributors",
         packages=find_packages(),
         include_package_data=True,
+        package_data={"biagent": ["data/*.json", "prompts/*.jinja"]},
         python_requires=">=3.10",
         license="MIT",
         install_requires=parse_requirements("requirements.txt"),